@@ -0,0 +1,128 @@
+import functools
+import hashlib
+import inspect
+from collections import OrderedDict
+
+import numpy as np
+
+from irr import irr_batch
+
+CACHE_SIZE = 128
+
+
+def array_key(args):
+    """Digest of the arguments' values, shapes and dtypes."""
+    h = hashlib.blake2b(digest_size=16)
+    for arg in args:
+        a = np.ascontiguousarray(arg)
+        h.update(f"{a.dtype.str}{a.shape}".encode())
+        h.update(a.tobytes())
+    return h.digest()
+
+
+def memoized(func):
+    """Memoize ``func`` on a hash of its array arguments, keeping the last
+    ``CACHE_SIZE`` results. Results are returned read-only since they are
+    shared between callers."""
+    cache = OrderedDict()
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Positional and keyword calls with the same values share an entry.
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = array_key(bound.arguments.values())
+        result = cache.get(key)
+        if result is not None:
+            cache.move_to_end(key)
+            return result
+        result = func(*bound.args, **bound.kwargs)
+        for a in result if isinstance(result, tuple) else (result,):
+            a.flags.writeable = False
+        cache[key] = result
+        if len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+        return result
+
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+def discount_matrix(rates, periods):
+    """(1 + r/12) ** -t for every rate (rows) and month 1..periods (columns)."""
+    t = np.arange(1, periods + 1, dtype=np.float64)
+    return (1 + np.asarray(rates, dtype=np.float64)[..., np.newaxis] / 12) ** -t
+
+
+@memoized
+def amortization(principal, year_rate, terms):
+    """
+    principal                       本金
+    year_rate                       年利率, 按月复利
+    terms                           期数
+
+    All three broadcast against each other, so a grid of rates x terms is
+    one call. Returns ``(payment, interest, repaid, balance)`` arrays of
+    shape ``broadcast shape + (max term,)``; months past a loan's term are 0.
+    """
+    principal, i, terms = np.broadcast_arrays(
+        np.asarray(principal, dtype=np.float64),
+        np.asarray(year_rate, dtype=np.float64) / 12,
+        np.asarray(terms, dtype=np.int64),
+    )
+    n = terms[..., np.newaxis]
+    t = np.arange(1, int(terms.max(initial=0)) + 1)
+    growth = (1 + i[..., np.newaxis]) ** t
+    with np.errstate(divide="ignore", invalid="ignore"):
+        level = principal * i / (1 - (1 + i) ** -terms)
+        # Balance after month t of a level-payment loan, zero-rate loans
+        # repaying a fixed share each month.
+        balance = np.where(
+            i[..., np.newaxis] != 0,
+            principal[..., np.newaxis] * growth
+            - level[..., np.newaxis] * (growth - 1) / i[..., np.newaxis],
+            principal[..., np.newaxis] * (1 - t / n),
+        )
+        level = np.where(i != 0, level, principal / terms)
+    previous = np.concatenate([principal[..., np.newaxis], balance[..., :-1]], axis=-1)
+    live = t <= n
+    interest = np.where(live, previous * i[..., np.newaxis], 0.0)
+    payment = np.where(live, level[..., np.newaxis], 0.0)
+    repaid = payment - interest
+    balance = np.where(live, np.maximum(balance, 0.0), 0.0)
+    return payment, interest, repaid, balance
+
+
+@memoized
+def npv_grid(principal, inflows, rates, rebates):
+    """
+    principal                       本金, 每笔贷款一个
+    inflows                         每期现金流, (贷款数, 期数)
+    rates                           候选年利率
+    rebates                         候选回扣
+
+    Returns NPVs of shape (loans, rates, rebates). The discount factors are
+    computed once for all loans, and the rebate only shifts the cost.
+    """
+    flows = np.atleast_2d(np.asarray(inflows, dtype=np.float64))
+    present = flows @ discount_matrix(rates, flows.shape[1]).T
+    cost = np.asarray(principal, dtype=np.float64).reshape(-1, 1, 1) - np.asarray(
+        rebates, dtype=np.float64
+    )
+    return present[:, :, np.newaxis] - cost
+
+
+@memoized
+def irr_grid(principal, inflows, rebates):
+    """每笔贷款在每个候选回扣下的年化利率, 形状为 (贷款数, 回扣数)"""
+    flows = np.atleast_2d(np.asarray(inflows, dtype=np.float64))
+    rebates = np.asarray(rebates, dtype=np.float64)
+    loans, k = flows.shape[0], rebates.size
+    principal = np.broadcast_to(np.asarray(principal, dtype=np.float64), (loans,))
+    rates = irr_batch(
+        np.repeat(principal, k),
+        np.tile(rebates, loans),
+        np.repeat(flows, k, axis=0),
+    )
+    return rates.reshape(loans, k)
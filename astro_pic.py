@@ -1,27 +1,94 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import NamedTuple
+
 import numpy as np
 
+try:
+    from numpy.dtypes import StringDType
+except ImportError:
+    # NumPy < 2.0: fixed-width strings and the legacy np.char functions
+    StringDType = None
+
+FRAME_CHUNK = 64
+# A warm start searches [guess / WARM_SPAN, guess * WARM_SPAN] first.
+WARM_SPAN = 1.5
+
+
+def partition(a, sep):
+    if StringDType is None:
+        if not a.size:
+            return a, a, a
+        parts = np.char.partition(a, sep)
+        return parts[..., 0], parts[..., 1], parts[..., 2]
+    return np.strings.partition(a, np.asarray(sep, a.dtype))
+
+
+def parse_sexagesimal(column, units, suffix):
+    """
+    Splits a column of strings like "16h4m10.9s" on its ``units`` with NumPy
+    string ops and returns a (n, 3) float64 array of whole units, minutes and
+    seconds, all carrying the value's sign (also of "-0°..."). The trailing
+    ``suffix`` may be left out, and so may the seconds, which are then 0.
+    """
+    if StringDType is None:
+        rest = np.asarray(column, dtype=str)
+        strings = np.char
+    else:
+        rest = np.asarray(column, dtype=StringDType())
+        strings = np.strings
+    fields = []
+    valid = np.ones(rest.shape, dtype=bool)
+    for unit in units:
+        head, sep, rest = partition(rest, unit)
+        valid &= sep == unit
+        fields.append(head)
+    seconds = strings.rstrip(strings.strip(rest), suffix)
+    fields.append(np.where(seconds == "", "0", seconds))
+    fields = np.stack(fields, axis=-1)
+    try:
+        if not valid.all():
+            raise ValueError
+        values = fields.astype(np.float64)
+    except ValueError:
+        for n, row in enumerate(fields.tolist()):
+            try:
+                if valid[n]:
+                    np.array(row, dtype=np.float64)
+                    continue
+            except ValueError:
+                pass
+            raise ValueError(f"第 {n + 1} 行无法解析: {column[n]!r}") from None
+        raise
+    sign = np.where(np.signbit(values[:, 0]), -1.0, 1.0)
+    values[:, 0] = np.abs(values[:, 0])
+    return values * sign[:, np.newaxis]
+
+
+def parse_hours(column):
+    """时角, 如 "16h4m10.9s", 末尾的 s 可省略; 返回弧度"""
+    h, m, s = parse_sexagesimal(column, "hm", "s").T
+    return np.deg2rad(360 - (h * 15 + m / 4 + s / 240))
+
+
+def parse_degrees(column):
+    """赤纬, 如 "-13°26'19.1\"", 末尾的 " 可省略; 返回弧度"""
+    d, m, s = parse_sexagesimal(column, "°'", '"').T
+    return np.deg2rad(d + m / 60 + s / 3600)
+
 
 def hour2rad(hms):
-    hms_split = hms.split("h")
-    h = float(hms_split[0])
-    ms_split = hms_split[1].split("m")
-    m = float(ms_split[0])
-    s = float(ms_split[1].split("s")[0])
-    deg = 360 - (h * 15 + m / 4 + s / 240)
-    return np.deg2rad(deg)
+    return parse_hours([hms])[0]
 
 
 def angle2rad(dms):
-    dms_split = dms.split("°")
-    d = float(dms_split[0])
-    ms_split = dms_split[1].split("'")
-    m = float(ms_split[0])
-    s = float(ms_split[1].split('"')[0])
-    deg = abs(d) + m / 60 + s / 3600
-    rad = np.deg2rad(deg)
-    if d < 0:
-        return -rad
-    return rad
+    return parse_degrees([dms])[0]
 
 
 def lnglat2xyz(lng, lat):
@@ -49,43 +116,145 @@ def calc_pixel_zenith_angle_cos(star_img, zenith, focal_length):
     return vec_angle_cos(v1, v2)
 
 
-def calc_observer_position(stars_hourangle, zenith_angle_cos_list):
-    f = get_focal_length(stars_hourangle, stars_img)
-
-    zenith_angle_cos_list = []
-    for star_img in stars_img:
-        zenith_angle_cos_obj = calc_pixel_zenith_angle_cos(zenith, star_img, f)
-        zenith_angle_cos_list.append(zenith_angle_cos_obj)
+def solve_frame(stars_hourangle, stars_img, zenith, guess=None):
+    """
+    stars_hourangle                 拍照时刻, 各天体的时角和赤纬
+    stars_img                       照片中各天体的坐标, 照片正中心为 0,0
+    zenith                          照片中天顶的坐标
+    guess                           焦距的初始估计, 如上一帧的焦距
 
-    A = np.array([hourangle_to_xyz(i) for i in stars_hourangle])
+    Returns ``(lat, lng, focal_length)``, lat and lng in degrees.
+    """
+    A = hourangles_to_xyz(stars_hourangle)
+    f = fit_focal_length(A, stars_img, guess)
 
-    b = np.array(zenith_angle_cos_list)
+    img = np.asarray(stars_img, dtype=np.float64)
+    img = np.column_stack([img, np.full(len(img), f)])
+    b = unit_vectors(img) @ unit_vectors([*zenith, f])
 
     res = np.linalg.pinv(A) @ b
     res /= np.linalg.norm(res)
 
     lat_rad, lng_rad = xyz2lnglat(res)
-    return np.rad2deg(lat_rad), np.rad2deg(lng_rad)
+    return np.rad2deg(lat_rad), np.rad2deg(lng_rad), f
 
 
-def calc_var_for_focal_length(stars_xyz, stars_img, f):
-    sum_of_square_diff = 0
-    n = len(stars_xyz)
-    for i in range(n):
-        star_i = stars_xyz[i]
-        img_i = [*stars_img[i], f]
+def calc_observer_position(stars_hourangle, stars_img, zenith):
+    lat, lng, _ = solve_frame(stars_hourangle, stars_img, zenith)
+    return lat, lng
 
-        for j in range(i + 1, n):
-            star_j = stars_xyz[j]
 
-            angle_cos = vec_angle_cos(star_i, star_j)
+def solve_chunk(frames):
+    """Solve consecutive frames, each warm-started from the one before."""
+    results = []
+    f = None
+    for stars_hourangle, stars_img, zenith in frames:
+        lat, lng, f = solve_frame(stars_hourangle, stars_img, zenith, f)
+        results.append((lat, lng, f))
+    return results
+
+
+def solve_frames(frames, workers=None, chunk=FRAME_CHUNK):
+    """
+    Yields ``(lat, lng, focal_length)`` for every frame, in order.
+
+    Frames are ``(stars_hourangle, stars_img, zenith)`` and are read lazily.
+    Runs of ``chunk`` consecutive frames are solved per process, so the warm
+    start holds within a run; at most two runs per process are in flight.
+    """
+    frames = iter(frames)
+    chunks = iter(lambda: list(islice(frames, chunk)), [])
+    if workers == 1:
+        f = None
+        for frames_chunk in chunks:
+            for stars_hourangle, stars_img, zenith in frames_chunk:
+                lat, lng, f = solve_frame(stars_hourangle, stars_img, zenith, f)
+                yield lat, lng, f
+        return
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        window = 2 * (workers or os.cpu_count() or 1)
+        for frames_chunk in chunks:
+            pending.append(pool.submit(solve_chunk, frames_chunk))
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def read_frames(path):
+    """每行一帧的 JSON: {"stars_hourangle": ..., "stars_img": ..., "zenith": ...}"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                frame = json.loads(line)
+                yield frame["stars_hourangle"], frame["stars_img"], frame["zenith"]
+
+
+def write_positions(frames, out, workers=None, chunk=FRAME_CHUNK):
+    """Solve frames and write one CSV row per frame as soon as it is solved."""
+    writer = csv.writer(out)
+    writer.writerow(["frame", "latitude", "longitude", "focal_length"])
+    for n, (lat, lng, f) in enumerate(solve_frames(frames, workers, chunk)):
+        lat = astronomic_latitude_to_geodetic_latitude(lat)
+        writer.writerow([n, repr(float(lat)), repr(float(lng)), repr(f)])
+
+
+def unit_vectors(v):
+    v = np.asarray(v, dtype=np.float64)
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def pairwise_cos(v):
+    """Cosine of the angle between every two rows of ``v``."""
+    u = unit_vectors(v)
+    return u @ u.T
+
+
+def focal_length_objective(stars_xyz, stars_img):
+    """
+    Returns f -> sum over star pairs of (cos image angle - cos sky angle)^2.
+
+    Everything but f is precomputed for the upper triangle of pairs, so one
+    evaluation is a few array operations over n(n-1)/2 pairs.
+    """
+    i, j = np.triu_indices(len(stars_img), 1)
+    sky = pairwise_cos(stars_xyz)[i, j]
+    img = np.asarray(stars_img, dtype=np.float64)
+    # Image vectors are (x, y, f): their dot products are gram + f^2.
+    gram = img @ img.T
+    sq = np.diag(gram)
+    gram, sq_i, sq_j = gram[i, j], sq[i], sq[j]
+
+    def objective(f):
+        f2 = f * f
+        cos = (gram + f2) / np.sqrt((sq_i + f2) * (sq_j + f2))
+        return float(np.sum((cos - sky) ** 2))
+
+    return objective
 
-            img_j = [*stars_img[j], f]
-            img_angle_cos = vec_angle_cos(img_i, img_j)
 
-            square_diff = (img_angle_cos - angle_cos) ** 2
-            sum_of_square_diff += square_diff
-    return sum_of_square_diff
+def calc_var_for_focal_length(stars_xyz, stars_img, f):
+    return focal_length_objective(stars_xyz, stars_img)(f)
+
+
+def golden_section(func, a, b, tol):
+    """Minimum of a function unimodal on [a, b]."""
+    invphi = (np.sqrt(5) - 1) / 2
+    c = b - invphi * (b - a)
+    d = a + invphi * (b - a)
+    fc, fd = func(c), func(d)
+    while b - a > tol:
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - invphi * (b - a)
+            fc = func(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + invphi * (b - a)
+            fd = func(d)
+    return (a + b) / 2
 
 
 def hourangle_to_xyz(hourangle):
@@ -95,22 +264,82 @@ def hourangle_to_xyz(hourangle):
     return xyz
 
 
-def get_focal_length(stars_hourangle, stars_img):
-    stars_xyz = [hourangle_to_xyz(i) for i in stars_hourangle]
-
-    l = 0
-    r = 1e9
-    for _ in range(100):
-        ml = (r - l) / 3 + l
-        mr = (r - l) * 2 / 3 + l
-
-        var_z1 = calc_var_for_focal_length(stars_xyz, stars_img, ml)
-        var_z2 = calc_var_for_focal_length(stars_xyz, stars_img, mr)
-        if var_z1 > var_z2:
-            l = ml
-        else:
-            r = mr
-    return r
+def hourangles_to_xyz(stars_hourangle):
+    """(n, 3) unit vectors for a list of [时角, 赤纬] pairs."""
+    hours, degrees = zip(*stars_hourangle) if len(stars_hourangle) else ((), ())
+    return np.column_stack(lnglat2xyz(parse_hours(hours), parse_degrees(degrees)))
+
+
+class Catalogue(NamedTuple):
+    lng: np.ndarray
+    lat: np.ndarray
+    xyz: np.ndarray
+
+
+def load_catalogue(path, hour="hourangle", dec="declination", cache=True):
+    """
+    path                            星表 CSV 文件, 第一行为列名
+    hour                            时角列名, 如 16h4m10.9s
+    dec                             赤纬列名, 如 13°39'15.2"
+    cache                           是否缓存解析结果
+
+    The parsed radians are cached next to the CSV as ``<path>.<hour>.<dec>.npy``
+    and memory-mapped on later loads while the cache is newer than the CSV.
+    """
+    cache_path = f"{path}.{hour}.{dec}.npy"
+    if cache and (
+        os.path.exists(cache_path)
+        and os.stat(cache_path).st_mtime_ns >= os.stat(path).st_mtime_ns
+    ):
+        lnglat = np.load(cache_path, mmap_mode="r")
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            i, j = header.index(hour), header.index(dec)
+            rows = [(row[i], row[j]) for row in reader if row]
+        hours, degrees = zip(*rows) if rows else ((), ())
+        lnglat = np.column_stack([parse_hours(hours), parse_degrees(degrees)])
+        if cache:
+            # Write then rename, so a concurrent reader never maps half a file.
+            tmp = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, lnglat)
+            os.replace(tmp, cache_path)
+    lng, lat = lnglat[:, 0], lnglat[:, 1]
+    return Catalogue(lng, lat, np.column_stack(lnglat2xyz(lng, lat)))
+
+
+def minimize_on_log_grid(objective, grid):
+    """
+    Refines the best point of a log-spaced grid by golden-section search over
+    log f. Returns the minimum and whether the best grid point was an end.
+    """
+    k = int(np.argmin([objective(f) for f in grid]))
+    a, b = np.log(grid[max(k - 1, 0)]), np.log(grid[min(k + 1, len(grid) - 1)])
+    f = float(np.exp(golden_section(lambda x: objective(np.exp(x)), a, b, 1e-12)))
+    return f, k in (0, len(grid) - 1)
+
+
+def fit_focal_length(stars_xyz, stars_img, guess=None, lo=1.0, hi=1e9):
+    objective = focal_length_objective(stars_xyz, stars_img)
+
+    # Neighbouring frames of a sequence share the lens, so a guess is
+    # checked in a narrow window first and only a miss scans [lo, hi].
+    if guess is not None:
+        grid = np.geomspace(guess / WARM_SPAN, guess * WARM_SPAN, 9)
+        f, at_end = minimize_on_log_grid(objective, grid)
+        if not at_end:
+            return f
+
+    # Ten points per decade bracket the global minimum.
+    grid = np.geomspace(lo, hi, int(np.log10(hi / lo) * 10) + 1)
+    return minimize_on_log_grid(objective, grid)[0]
+
+
+def get_focal_length(stars_hourangle, stars_img, lo=1.0, hi=1e9):
+    stars_xyz = hourangles_to_xyz(stars_hourangle)
+    return fit_focal_length(stars_xyz, stars_img, lo=lo, hi=hi)
 
 
 def astronomic_latitude_to_geodetic_latitude(astronomic_latitudes_in_degree):
@@ -128,35 +357,57 @@ def astronomic_latitude_to_geodetic_latitude(astronomic_latitudes_in_degree):
     return astronomic_latitudes_in_degree + np.rad2deg(res)
 
 
-# 拍照时刻，天体在地球 0° 经线处的时角和赤经
-star_hourangle_1 = ["16h4m10.9s", "13°39'15.2\""]
-star_hourangle_2 = ["15h36m7.09s", "4°11'4.5\""]
-star_hourangle_3 = ["14h50m44.52", "24°10'46.5\""]
-star_hourangle_4 = ["14h37m29.76", "-13°26'19.1\""]
-star_hourangle_5 = ["15h55m6.43", "3°20'16.6\""]
-
-# 照片中，天体的坐标；其中，照片正中心为 0,0
-star_img_1 = [44, -130.5]
-star_img_2 = [-97, 97.5]
-star_img_3 = [-384, -364.5]
-star_img_4 = [-412, 580.5]
-star_img_5 = [13, 106.5]
-
-# 照片中，天顶的坐标
-zenith = [-117.5, -857.5]
-
-stars_hourangle = [
-    star_hourangle_1,
-    star_hourangle_2,
-    star_hourangle_3,
-    star_hourangle_4,
-    star_hourangle_5,
-]
-stars_img = [star_img_1, star_img_2, star_img_3, star_img_4, star_img_5]
-
-
-lat, lng = calc_observer_position(stars_hourangle, stars_img)
-
-lat = astronomic_latitude_to_geodetic_latitude(lat)
-
-print("{},{}".format(lat, lng))
+def main():
+    parser = argparse.ArgumentParser(description="由照片中的天体位置求拍摄地的经纬度")
+    parser.add_argument("frames", nargs="?", help="每行一帧的 JSON 文件")
+    parser.add_argument("-o", "--output", help="结果 CSV 文件, 默认为标准输出")
+    parser.add_argument("--workers", type=int, help="进程数, 默认为 CPU 核数")
+    parser.add_argument(
+        "--chunk", type=int, default=FRAME_CHUNK, help="每个进程一次求解的连续帧数"
+    )
+    args = parser.parse_args()
+
+    if args.frames is None:
+        # 拍照时刻，天体在地球 0° 经线处的时角和赤经
+        star_hourangle_1 = ["16h4m10.9s", "13°39'15.2\""]
+        star_hourangle_2 = ["15h36m7.09s", "4°11'4.5\""]
+        star_hourangle_3 = ["14h50m44.52", "24°10'46.5\""]
+        star_hourangle_4 = ["14h37m29.76", "-13°26'19.1\""]
+        star_hourangle_5 = ["15h55m6.43", "3°20'16.6\""]
+
+        # 照片中，天体的坐标；其中，照片正中心为 0,0
+        star_img_1 = [44, -130.5]
+        star_img_2 = [-97, 97.5]
+        star_img_3 = [-384, -364.5]
+        star_img_4 = [-412, 580.5]
+        star_img_5 = [13, 106.5]
+
+        # 照片中，天顶的坐标
+        zenith = [-117.5, -857.5]
+
+        stars_hourangle = [
+            star_hourangle_1,
+            star_hourangle_2,
+            star_hourangle_3,
+            star_hourangle_4,
+            star_hourangle_5,
+        ]
+        stars_img = [star_img_1, star_img_2, star_img_3, star_img_4, star_img_5]
+
+        lat, lng = calc_observer_position(stars_hourangle, stars_img, zenith)
+
+        lat = astronomic_latitude_to_geodetic_latitude(lat)
+
+        print("{},{}".format(lat, lng))
+        return
+
+    frames = read_frames(args.frames)
+    if args.output:
+        with open(args.output, "w", newline="", encoding="utf-8") as out:
+            write_positions(frames, out, args.workers, args.chunk)
+    else:
+        write_positions(frames, sys.stdout, args.workers, args.chunk)
+
+
+if __name__ == "__main__":
+    main()
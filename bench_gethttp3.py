@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""Benchmark suite for gethttp3.py.
+
+Generates a corpus in a temporary directory (tiny and medium files, a
+multi-GB sparse file and a very large directory), starts the server on a
+loopback port and drives GET, Range, listing, download and multipart upload
+workloads from asyncio clients at each concurrency level. Every run reports
+req/s, MB/s, p50/p99 latency, peak RSS and peak thread count of the server;
+the report is printed as JSON. With ``--tls`` a self-signed certificate is
+generated with ``openssl`` and everything goes over HTTPS.
+
+Runs offline on one Linux box (``/proc`` is used for RSS and threads).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORKLOADS = ["get-tiny", "get-medium", "range", "listing", "download", "upload"]
+BOUNDARY = "benchboundary7MA4YWxkTrZu0gW"
+
+
+def read_proc_status(pid, key):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def make_corpus(root, args):
+    """Fill ``root`` and return the paths each workload requests."""
+    rng = random.Random(0)
+    tiny = []
+    os.makedirs(os.path.join(root, "tiny"))
+    for i in range(args.tiny_files):
+        name = f"tiny/t{i:05d}.txt"
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(rng.randbytes(rng.randint(100, 4096)))
+        tiny.append("/" + name)
+
+    medium = []
+    os.makedirs(os.path.join(root, "medium"))
+    block = rng.randbytes(1 << 20)
+    for i in range(args.medium_files):
+        name = f"medium/m{i:03d}.bin"
+        with open(os.path.join(root, name), "wb") as f:
+            for _ in range(args.medium_mb):
+                f.write(block)
+        medium.append("/" + name)
+
+    with open(os.path.join(root, "big.bin"), "wb") as f:
+        f.truncate(args.big_gb << 30)
+
+    huge = os.path.join(root, "huge")
+    os.makedirs(huge)
+    for i in range(args.dir_entries):
+        open(os.path.join(huge, f"entry-{i:07d}.dat"), "wb").close()
+
+    os.makedirs(os.path.join(root, "uploads"))
+    return {"tiny": tiny, "medium": medium, "big_size": args.big_gb << 30}
+
+
+def make_certificate(root):
+    cert, key = os.path.join(root, "cert.pem"), os.path.join(root, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes"]
+        + ["-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=localhost"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def start_server(root, port, engine, tls=None, extra=()):
+    command = [
+        sys.executable,
+        os.path.join(HERE, "gethttp3.py"),
+        "--port",
+        str(port),
+        "--engine",
+        engine,
+        *extra,
+    ]
+    if tls:
+        command += ["--tls", *tls]
+    # A server left over from an earlier run would be benchmarked instead
+    try:
+        socket.create_connection(("127.0.0.1", port)).close()
+    except OSError:
+        pass
+    else:
+        raise RuntimeError(f"port {port} is already in use")
+    proc = subprocess.Popen(
+        command,
+        cwd=root,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with status {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def client_context():
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class Deadline(Exception):
+    pass
+
+
+class Connection:
+    """Minimal keep-alive HTTP/1.1 client that counts body bytes."""
+
+    def __init__(self, port, context):
+        self.port = port
+        self.context = context
+        self.reader = self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            "127.0.0.1", self.port, ssl=self.context
+        )
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, method, path, headers=(), body=b"", deadline=None):
+        """Send one request; return the status and the response body size.
+
+        Raises Deadline if the body is still arriving at ``deadline``.
+        """
+        if self.writer is None:
+            await self.open()
+        lines = [f"{method} {path} HTTP/1.1", "Host: 127.0.0.1"]
+        lines += [f"{k}: {v}" for k, v in headers]
+        if body or method in ("POST", "PUT"):
+            lines.append(f"Content-Length: {len(body)}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        await self.writer.drain()
+
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        status_line, *header_lines = head.decode("latin-1").split("\r\n")
+        status = int(status_line.split()[1])
+        fields = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            fields[name.strip().lower()] = value.strip()
+        if method == "HEAD" or status in (204, 304):
+            size = 0
+        elif "content-length" in fields:
+            size = await self.read_exactly(int(fields["content-length"]), deadline)
+        elif fields.get("transfer-encoding") == "chunked":
+            size = await self.read_chunked(deadline)
+        else:
+            size = await self.read_exactly(None, deadline)
+            fields["connection"] = "close"
+        if fields.get("connection", "").lower() == "close":
+            self.close()
+        return status, size
+
+    async def read_exactly(self, n, deadline):
+        received = 0
+        while n is None or received < n:
+            if deadline is not None and time.perf_counter() > deadline:
+                self.close()
+                raise Deadline(received)
+            limit = 1 << 20 if n is None else min(1 << 20, n - received)
+            chunk = await self.reader.read(limit)
+            if not chunk:
+                if n is None:
+                    break
+                raise ConnectionError("connection closed mid-body")
+            received += len(chunk)
+        return received
+
+    async def read_chunked(self, deadline):
+        received = 0
+        while True:
+            size = int((await self.reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await self.reader.readline()
+                return received
+            received += await self.read_exactly(size, deadline)
+            await self.reader.readexactly(2)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+
+def request_factory(workload, corpus, args):
+    """Return a function building the i-th request of ``workload``."""
+    rng = random.Random(workload)
+    if workload == "get-tiny":
+        return lambda i: ("GET", rng.choice(corpus["tiny"]), (), b"")
+    if workload == "get-medium":
+        return lambda i: ("GET", rng.choice(corpus["medium"]), (), b"")
+    if workload == "download":
+        return lambda i: ("GET", "/big.bin", (), b"")
+    if workload == "range":
+        span = args.range_kb << 10
+
+        def make(i):
+            start = rng.randrange(0, corpus["big_size"] - span)
+            headers = [("Range", f"bytes={start}-{start + span - 1}")]
+            return "GET", "/big.bin", headers, b""
+
+        return make
+    if workload == "listing":
+        pages = max(1, args.dir_entries // 500)
+        queries = [
+            lambda: "",
+            lambda: f"?page={rng.randint(1, pages)}",
+            lambda: f"?format=json&sort=mtime&page={rng.randint(1, pages)}",
+        ]
+        return lambda i: ("GET", "/huge/" + queries[i % len(queries)](), (), b"")
+    if workload == "upload":
+        payload = random.Random(1).randbytes(args.upload_kb << 10)
+
+        def make(i):
+            body = (
+                f"--{BOUNDARY}\r\n"
+                f'Content-Disposition: form-data; name="file"; filename="u{i}.bin"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode()
+            body += payload + f"\r\n--{BOUNDARY}--\r\n".encode()
+            headers = [("Content-Type", f"multipart/form-data; boundary={BOUNDARY}")]
+            return "POST", "/uploads/", headers, body
+
+        return make
+    raise ValueError(workload)
+
+
+async def run_workload(workload, concurrency, corpus, args, pid, context):
+    make = request_factory(workload, corpus, args)
+    latencies = []
+    counts = {"requests": 0, "errors": 0, "bytes": 0}
+    peak = {"rss": 0, "anon": 0, "threads": 0}
+    issued = 0
+    start = time.perf_counter()
+    deadline = start + args.duration
+    done = asyncio.Event()
+
+    async def sample():
+        while not done.is_set():
+            peak["rss"] = max(peak["rss"], read_proc_status(pid, "VmRSS"))
+            peak["anon"] = max(peak["anon"], read_proc_status(pid, "RssAnon"))
+            peak["threads"] = max(peak["threads"], read_proc_status(pid, "Threads"))
+            await asyncio.sleep(0.01)
+
+    async def worker():
+        nonlocal issued
+        conn = Connection(args.port, context)
+        try:
+            while time.perf_counter() < deadline:
+                method, path, headers, body = make(issued)
+                issued += 1
+                t0 = time.perf_counter()
+                try:
+                    status, size = await conn.request(
+                        method, path, headers, body, deadline
+                    )
+                except Deadline as e:
+                    # A body cut off at the end still counts towards MB/s.
+                    counts["bytes"] += e.args[0]
+                    break
+                except (OSError, asyncio.IncompleteReadError, ValueError):
+                    counts["errors"] += 1
+                    conn.close()
+                    continue
+                latencies.append(time.perf_counter() - t0)
+                counts["bytes"] += size + len(body)
+                if status >= 400:
+                    counts["errors"] += 1
+                else:
+                    counts["requests"] += 1
+        finally:
+            conn.close()
+
+    sampler = asyncio.create_task(sample())
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await sampler
+
+    latencies.sort()
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {
+        "workload": workload,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests": counts["requests"],
+        "errors": counts["errors"],
+        "req_per_s": round(counts["requests"] / elapsed, 1),
+        "mb_per_s": round(counts["bytes"] / elapsed / 2**20, 1),
+        "p50_ms": p50 and round(p50 * 1000, 3),
+        "p99_ms": p99 and round(p99 * 1000, 3),
+        "peak_rss_mb": round(peak["rss"] / 1024, 1),
+        "peak_anon_mb": round(peak["anon"] / 1024, 1),
+        "peak_threads": peak["threads"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite for gethttp3.py")
+    parser.add_argument("--port", type=int, default=8765, help="Port number")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--tls", action="store_true", help="Benchmark over HTTPS")
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=WORKLOADS)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[1, 16, 64], help="Clients"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=5, help="Seconds per workload run"
+    )
+    parser.add_argument("--tiny-files", type=int, default=1000)
+    parser.add_argument("--medium-files", type=int, default=8)
+    parser.add_argument("--medium-mb", type=int, default=4)
+    parser.add_argument("--big-gb", type=int, default=4, help="Sparse file size")
+    parser.add_argument("--dir-entries", type=int, default=50000)
+    parser.add_argument("--range-kb", type=int, default=64)
+    parser.add_argument("--upload-kb", type=int, default=64)
+    parser.add_argument(
+        "--server-arg",
+        action="append",
+        default=[],
+        help="Extra argument passed to gethttp3.py, may be repeated",
+    )
+    parser.add_argument("--output", help="Write the JSON report here")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        print("generating corpus...", file=sys.stderr)
+        corpus = make_corpus(root, args)
+        tls = make_certificate(root) if args.tls else None
+        context = client_context() if args.tls else None
+        proc = start_server(root, args.port, args.engine, tls, args.server_arg)
+        results = []
+        try:
+            for workload in args.workloads:
+                for n in args.concurrency:
+                    result = asyncio.run(
+                        run_workload(workload, n, corpus, args, proc.pid, context)
+                    )
+                    print(
+                        f"{workload:<12} x{n:<4} {result['req_per_s']:>10} req/s"
+                        f" {result['mb_per_s']:>9} MB/s p99 {result['p99_ms']} ms",
+                        file=sys.stderr,
+                    )
+                    results.append(result)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    report = {
+        "engine": args.engine,
+        "tls": args.tls,
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "corpus": {
+            "tiny_files": args.tiny_files,
+            "medium_files": args.medium_files,
+            "medium_mb": args.medium_mb,
+            "big_gb": args.big_gb,
+            "dir_entries": args.dir_entries,
+        },
+        "server_args": args.server_arg,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,91 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import email.utils
+import functools
+import hashlib
+import importlib.util
 import html
+import io
+import json
 import logging
 import mimetypes
+import mmap
 import os
 import posixpath
 import re
-import subprocess
+import select
+import selectors
+import socket
+import stat
+import struct
+import threading
+import time
 import urllib
 import uuid
+import zlib
+from collections import OrderedDict
 from datetime import datetime
-from enum import Enum
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import NamedTuple
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-class LoopInfo(Enum):
-    OUTER = 1
-    INNER = 2
-    LEAVE = 3
+# asyncio, ssl, ctypes, concurrent.futures, zipfile, tarfile and the
+# optional compressors are imported where they are used, to start fast.
 
+COPY_BUFSIZE = 256 * 1024
+TLS_WRITE_SIZE = 1024 * 1024
+MAX_PART_HEADER_SIZE = 64 * 1024
+KEEPALIVE_GRACE = 0.05
+KEEPALIVE_POLL = 0.005
+# How long a rejected connection is drained before it is closed.
+REJECT_LINGER = 1.0
+PRIORITY_WINDOW = 1.0
 
-def get_local_ip():
-    def parse_ip(output):
-        return re.findall(r"inet\s+(192\.168\.\d+\.\d+)", output)
 
-    def get_ip_from_command(cmd):
-        try:
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=True)
-            return parse_ip(result.stdout)
-        except subprocess.CalledProcessError:
-            pass
-        return []
+SIOCGIFADDR = 0x8915
 
-    ip_list = get_ip_from_command(["ifconfig"])
-    if ip_list:
-        return ip_list[0]
 
-    ip_list = get_ip_from_command(["ip", "addr"])
-    if ip_list:
-        return ip_list[0]
+def get_local_ips():
+    """Non-loopback IPv4 and IPv6 addresses of this host.
 
-    return "[::]"
+    Asks the kernel directly, SIOCGIFADDR per interface and
+    /proc/net/if_inet6, rather than running ifconfig or ip. Where neither
+    is available the addresses the host name resolves to are used.
+    """
+    ips = []
+    if fcntl is not None and hasattr(socket, "if_nameindex"):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for _, name in socket.if_nameindex():
+                ifreq = struct.pack("256s", name.encode()[:15])
+                try:
+                    ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, ifreq)
+                except OSError:
+                    continue
+                ips.append(socket.inet_ntoa(ifreq[20:24]))
+    try:
+        with open("/proc/net/if_inet6") as f:
+            for line in f:
+                addr, _, _, scope = line.split()[:4]
+                # Global scope only: link-local addresses need a zone id.
+                if scope == "00":
+                    ips.append(socket.inet_ntop(socket.AF_INET6, bytes.fromhex(addr)))
+    except OSError:
+        pass
+    if not ips:
+        try:
+            infos = socket.getaddrinfo(socket.gethostname(), None)
+        except OSError:
+            infos = []
+        ips = [info[4][0] for info in infos if "%" not in info[4][0]]
+    return [
+        ip for ip in dict.fromkeys(ips) if not ip.startswith("127.") and ip != "::1"
+    ]
 
 
 def format_size(size):
@@ -64,37 +108,1928 @@ def safe_save_path(path, filename):
     return full_path
 
 
-def init_mimetypes():
-    if not mimetypes.inited:
-        mimetypes.init()
-    extensions_map = mimetypes.types_map.copy()
-    extensions_map.update(
-        {
-            ".py": "text/plain",
-            ".c": "text/plain",
-            ".h": "text/plain",
-        }
-    )
-    return extensions_map
+@functools.lru_cache(maxsize=None)
+def init_mimetypes():
+    if not mimetypes.inited:
+        mimetypes.init()
+    extensions_map = mimetypes.types_map.copy()
+    extensions_map.update(
+        {
+            ".py": "text/plain",
+            ".c": "text/plain",
+            ".h": "text/plain",
+        }
+    )
+    return extensions_map
+
+
+class FileBody:
+    """Response body served from an open file, as a list of segments.
+
+    Each segment is either ``bytes`` written as is, or an ``(offset, count)``
+    pair copied from the file, so the file never has to be read into memory.
+    """
+
+    def __init__(self, f, segments):
+        self.f = f
+        self.segments = segments
+
+    def close(self):
+        self.f.close()
+
+
+class MultipartError(Exception):
+    pass
+
+
+class MultipartReader:
+    """Incremental ``multipart/form-data`` parser over fixed-size chunks.
+
+    Reads at most ``length`` bytes from ``rfile``, finds boundaries that
+    straddle chunk edges, and never holds more than about one chunk of the
+    body in memory, however large the uploaded files are.
+    """
+
+    def __init__(self, rfile, boundary, length, chunk_size=COPY_BUFSIZE):
+        self.rfile = rfile
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.delimiter = b"\r\n--" + boundary
+        # The first boundary has no leading CRLF; pretend it does so every
+        # boundary matches the same delimiter.
+        self.buf = bytearray(b"\r\n")
+        self.started = False
+
+    def fill(self):
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not data:
+            self.remaining = 0
+            return False
+        self.remaining -= len(data)
+        self.buf += data
+        return True
+
+    def next_part(self):
+        """Skip to the next part and return its headers, or None at the end."""
+        if not self.started:
+            self.copy_to(None)
+            self.started = True
+        while len(self.buf) < 2:
+            if not self.fill():
+                raise MultipartError("Unexpected end of data")
+        tail = bytes(self.buf[:2])
+        del self.buf[:2]
+        if tail == b"--":
+            # Discard the epilogue so the connection can be reused.
+            while self.fill():
+                self.buf.clear()
+            return None
+        if tail != b"\r\n":
+            raise MultipartError("Content NOT begin with boundary")
+
+        while True:
+            end = self.buf.find(b"\r\n\r\n")
+            if end >= 0:
+                break
+            if len(self.buf) > MAX_PART_HEADER_SIZE:
+                raise MultipartError("Part header too large")
+            if not self.fill():
+                raise MultipartError("Unexpected end of data")
+        head = self.buf[:end].decode("utf-8", "replace")
+        del self.buf[: end + 4]
+        headers = {}
+        for line in head.split("\r\n"):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def copy_to(self, out):
+        """Copy the body of the current part to ``out``, or discard it if None."""
+        delimiter = self.delimiter
+        keep = len(delimiter) - 1
+        while True:
+            idx = self.buf.find(delimiter)
+            if idx >= 0:
+                self.consume(out, idx)
+                del self.buf[: len(delimiter)]
+                return
+            if len(self.buf) > keep:
+                self.consume(out, len(self.buf) - keep)
+            if not self.fill():
+                raise MultipartError("Unexpected end of data")
+
+    def consume(self, out, n):
+        if out is not None and n:
+            with memoryview(self.buf) as view:
+                out.write(view[:n])
+        del self.buf[:n]
+
+
+# Preferred first; only encodings whose module is installed are offered.
+ENCODINGS = [
+    enc
+    for enc, module in [("br", "brotli"), ("zstd", "zstandard"), ("gzip", "zlib")]
+    if importlib.util.find_spec(module)
+]
+ENCODING_SUFFIXES = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/xml",
+    "image/svg+xml",
+}
+MIN_COMPRESS_SIZE = 1024
+
+
+def is_compressible(ctype):
+    return ctype.startswith("text/") or ctype in COMPRESSIBLE_TYPES
+
+
+def new_compressor(encoding):
+    """Return ``(compress, flush)`` callables of a streaming compressor."""
+    if encoding == "br":
+        import brotli
+
+        c = brotli.Compressor(quality=5)
+        return c.process, c.finish
+    if encoding == "zstd":
+        import zstandard
+
+        c = zstandard.ZstdCompressor(level=3).compressobj()
+        return c.compress, c.flush
+    c = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return c.compress, c.flush
+
+
+def compress_bytes(data, encoding):
+    compress, flush = new_compressor(encoding)
+    return compress(data) + flush()
+
+
+def compress_chunks(chunks, encoding):
+    compress, flush = new_compressor(encoding)
+    for chunk in chunks:
+        out = compress(chunk)
+        if out:
+            yield out
+    yield flush()
+
+
+def variant_etag(etag, encoding):
+    return f'{etag[:-1]}-{encoding}"' if encoding else etag
+
+
+class CompressedFileBody:
+    """Streams an open file through a compressor.
+
+    With ``cache_path`` the compressed output is also written next to it
+    and moved into place once complete, stamped with the mtime of the file,
+    so the file is compressed only once. Output of a file that changed while
+    it was read is not kept.
+    """
+
+    def __init__(self, f, encoding, cache_path=None):
+        self.f = f
+        self.encoding = encoding
+        self.cache_path = cache_path
+        self.tmp_path = None
+
+    def __iter__(self):
+        cache = None
+        if self.cache_path:
+            self.tmp_path = f"{self.cache_path}.{uuid.uuid4().hex}.tmp"
+            cache = open(self.tmp_path, "wb")
+            before = os.fstat(self.f.fileno())
+        try:
+            for chunk in compress_chunks(iter(self.read, b""), self.encoding):
+                if cache:
+                    cache.write(chunk)
+                yield chunk
+            if cache:
+                after = os.fstat(self.f.fileno())
+        finally:
+            self.f.close()
+            if cache:
+                cache.close()
+        if self.tmp_path:
+            validator = (after.st_mtime_ns, after.st_size)
+            if validator != (before.st_mtime_ns, before.st_size):
+                os.remove(self.tmp_path)
+            else:
+                os.utime(self.tmp_path, ns=(after.st_atime_ns, after.st_mtime_ns))
+                os.replace(self.tmp_path, self.cache_path)
+            self.tmp_path = None
+
+    def read(self):
+        return self.f.read(COPY_BUFSIZE)
+
+    def close(self):
+        self.f.close()
+        if self.tmp_path:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+
+ARCHIVE_TYPES = {
+    "zip": "application/zip",
+    "tar": "application/x-tar",
+    "tar.zst": "application/zstd",
+}
+# Already-compressed formats are stored in zip archives as is.
+STORED_EXTENSIONS = {
+    ".7z",
+    ".aac",
+    ".avi",
+    ".br",
+    ".bz2",
+    ".flac",
+    ".gif",
+    ".gz",
+    ".heic",
+    ".jpeg",
+    ".jpg",
+    ".m4a",
+    ".mkv",
+    ".mov",
+    ".mp3",
+    ".mp4",
+    ".ogg",
+    ".png",
+    ".rar",
+    ".webm",
+    ".webp",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+
+
+class ArchiveSink:
+    """Write-only file object whose output is drained by a generator."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def walk_tree(root):
+    """Yield ``(path, arcname, is_dir)`` for the files listings show, lazily."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        filenames.sort()
+        rel = os.path.relpath(dirpath, root)
+        prefix = "" if rel == os.curdir else rel.replace(os.sep, "/") + "/"
+        if prefix:
+            yield dirpath, prefix, True
+        for name in filenames:
+            if name.startswith(UPLOAD_PREFIX):
+                # Unfinished uploads, as in listings
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                # FIFOs, sockets and devices would block or misbehave on open
+                if not stat.S_ISREG(os.stat(path).st_mode):
+                    continue
+            except OSError:
+                continue
+            yield path, prefix + name, False
+
+
+def open_regular(path):
+    """Open ``path`` if it is a regular file, without blocking on a FIFO.
+
+    Guards against a file being replaced after walk_tree listed it.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode):
+            raise OSError(f"not a regular file: {path}")
+        return os.fdopen(fd, "rb")
+    except BaseException:
+        os.close(fd)
+        raise
+
+
+def iter_zip(root):
+    """Stream a zip of ``root``; entries use data descriptors, no seeking."""
+    import zipfile
+
+    sink = ArchiveSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path, arcname, is_dir in walk_tree(root):
+            try:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname)
+                f = None if is_dir else open_regular(path)
+            except OSError:
+                continue
+            if f is None:
+                zf.writestr(zinfo, b"")
+            else:
+                ext = posixpath.splitext(arcname)[1].lower()
+                if ext in STORED_EXTENSIONS:
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                else:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with f, zf.open(zinfo, "w") as dest:
+                    for chunk in iter(lambda: f.read(COPY_BUFSIZE), b""):
+                        dest.write(chunk)
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_tar(root):
+    """Stream a PAX tar of ``root`` with file data copied chunk by chunk."""
+    import tarfile
+
+    written = 0
+    for path, arcname, is_dir in walk_tree(root):
+        try:
+            f = None if is_dir else open_regular(path)
+            st = os.stat(path) if f is None else os.fstat(f.fileno())
+        except OSError:
+            continue
+        info = tarfile.TarInfo(arcname)
+        info.mtime = st.st_mtime
+        info.mode = st.st_mode & 0o7777
+        if f is None:
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = st.st_size
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        written += len(header)
+        yield header
+        if f is None:
+            continue
+        with f:
+            # Exactly info.size bytes must follow the header, even if the
+            # file changes while it is being sent.
+            remaining = info.size
+            while remaining > 0:
+                chunk = f.read(min(COPY_BUFSIZE, remaining)) or bytes(
+                    min(COPY_BUFSIZE, remaining)
+                )
+                remaining -= len(chunk)
+                yield chunk
+        padding = -info.size % tarfile.BLOCKSIZE
+        written += info.size + padding
+        yield bytes(padding)
+    end = tarfile.BLOCKSIZE * 2
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield bytes(end)
+
+
+UPLOAD_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+UPLOAD_PREFIX = ".upload-"
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# Unfinished uploads untouched for this long are deleted.
+UPLOAD_EXPIRY = 24 * 3600
+
+
+class UploadRejected(Exception):
+    """An upload that cannot be accepted; args are the status and reason."""
+
+
+class UploadSession:
+    """One chunked upload: a preallocated ``.part`` file plus a manifest.
+
+    Chunks may arrive in any order and in parallel; each is written with
+    ``pwrite`` at its own offset. The manifest records which chunks have
+    arrived so an interrupted upload can be resumed, even after a restart.
+    """
+
+    content_store = None
+
+    def __init__(self, directory, upload_id, name, size, chunk_size, received=()):
+        self.directory = directory
+        self.upload_id = upload_id
+        self.name = name
+        self.size = size
+        self.chunk_size = chunk_size
+        self.received = set(received)
+        self.final_path = None
+        self.digest = None
+        self.lock = threading.Lock()
+        prefix = os.path.join(directory, UPLOAD_PREFIX + upload_id)
+        self.part_path = prefix + ".part"
+        self.manifest_path = prefix + ".json"
+
+    @property
+    def chunks(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    @classmethod
+    def load(cls, directory, upload_id):
+        session = cls(directory, upload_id, "", 0, 1)
+        with open(session.manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        session.name = manifest["name"]
+        session.size = manifest["size"]
+        session.chunk_size = manifest["chunk_size"]
+        session.received = set(manifest["received"])
+        return session
+
+    def create(self):
+        # Sparse: disk is only used as chunks arrive, so an abandoned upload
+        # costs what was actually sent.
+        with open(self.part_path, "wb") as f:
+            f.truncate(self.size)
+        with self.lock:
+            self.save_or_finish()
+
+    def write_chunk(self, index, rfile, length):
+        """Copy ``length`` bytes of ``rfile`` into chunk ``index``."""
+        offset = index * self.chunk_size
+        buf = memoryview(bytearray(min(COPY_BUFSIZE, max(length, 1))))
+        fd = os.open(self.part_path, os.O_WRONLY)
+        try:
+            while length > 0:
+                n = rfile.readinto(buf[: min(length, len(buf))])
+                if not n:
+                    raise ConnectionError("Unexpected end of data")
+                os.pwrite(fd, buf[:n], offset)
+                offset += n
+                length -= n
+        finally:
+            os.close(fd)
+        with self.lock:
+            self.received.add(index)
+            self.save_or_finish()
+
+    def save_or_finish(self):
+        if self.final_path is not None:
+            return
+        if len(self.received) < self.chunks:
+            manifest = {
+                "name": self.name,
+                "size": self.size,
+                "chunk_size": self.chunk_size,
+                "received": sorted(self.received),
+            }
+            tmp = self.manifest_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            os.replace(tmp, self.manifest_path)
+            return
+        self.final_path = safe_save_path(self.directory, self.name)
+        os.rename(self.part_path, self.final_path)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        # Chunks arrive out of order, so the file is hashed once it is whole.
+        self.digest = file_digest(self.final_path)
+        if self.content_store:
+            self.content_store.add(self.final_path, self.digest)
+        logging.info(f"chunked upload finished: {self.final_path}")
+
+    def status(self):
+        return {
+            "id": self.upload_id,
+            "name": self.name,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "received": sorted(self.received),
+            "complete": self.final_path is not None,
+            "path": self.final_path and os.path.basename(self.final_path),
+            "hash": self.digest,
+        }
+
+
+class UploadRegistry:
+    """Chunked uploads in progress, keyed on target directory and upload id.
+
+    New uploads larger than ``max_size`` (if set) or than the free space are
+    rejected, and starting one deletes the directory's uploads that have not
+    been touched for ``expiry`` seconds.
+    """
+
+    def __init__(self, max_size=0, expiry=UPLOAD_EXPIRY):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.expiry = expiry
+
+    def get(self, directory, upload_id):
+        key = (directory, upload_id)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or session.final_path is not None:
+                try:
+                    session = UploadSession.load(directory, upload_id)
+                except (OSError, ValueError, KeyError):
+                    self.sessions.pop(key, None)
+                    return None
+                self.sessions[key] = session
+            return session
+
+    def start(self, directory, upload_id, name, size, chunk_size):
+        session = self.get(directory, upload_id)
+        spec = (name, size, chunk_size)
+        if session and (session.name, session.size, session.chunk_size) == spec:
+            return session
+        self.prune(directory)
+        if self.max_size and size > self.max_size:
+            raise UploadRejected(413, "Upload too large")
+        st = os.statvfs(directory)
+        if size > st.f_bavail * st.f_frsize:
+            raise UploadRejected(507, "Not enough free space")
+        session = UploadSession(directory, upload_id, name, size, chunk_size)
+        session.create()
+        with self.lock:
+            self.sessions[(directory, upload_id)] = session
+        return session
+
+    def prune(self, directory):
+        """Delete unfinished uploads in ``directory`` older than ``expiry``."""
+        if not self.expiry:
+            return
+        cutoff = time.time() - self.expiry
+        expired = set()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not entry.name.startswith(UPLOAD_PREFIX):
+                        continue
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.remove(entry.path)
+                            expired.add(entry.name[len(UPLOAD_PREFIX) :].split(".")[0])
+                    except OSError:
+                        pass
+        except OSError:
+            return
+        if expired:
+            logging.info(f"expired uploads in {directory}: {sorted(expired)}")
+            with self.lock:
+                for upload_id in expired:
+                    self.sessions.pop((directory, upload_id), None)
+
+
+DIGEST_RE = re.compile(r"[0-9a-f]{128}")
+# ioctl that makes a copy-on-write clone of a whole file (btrfs, XFS, ...).
+FICLONE = 0x40049409
+
+
+def new_hash():
+    # Plain BLAKE2b-512, so clients can compute the same digest with b2sum.
+    return hashlib.blake2b()
+
+
+def file_digest(path):
+    h = new_hash()
+    buf = memoryview(bytearray(COPY_BUFSIZE))
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return h.hexdigest()
+            h.update(buf[:n])
+
+
+class HashingWriter:
+    """File wrapper that hashes everything written through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = new_hash()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.f.write(data)
+
+
+def clone_file(src, dst):
+    """Create ``dst`` sharing the data of ``src`` without copying it.
+
+    A reflink is used where the filesystem supports one, a hardlink
+    otherwise. Returns False if neither works, e.g. across filesystems.
+    """
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    return True
+                except OSError:
+                    pass
+            os.remove(dst)
+        except OSError:
+            return False
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
+class ContentStore:
+    """Uploaded files keyed on their BLAKE2b digest.
+
+    The first upload of some content is cloned into the store; later uploads
+    of the same content are replaced by clones of the stored copy, so the
+    data is on disk once. Hardlinks only work if the store is on the same
+    filesystem as the served directory, and share the inode: editing one of
+    the files in place changes all of them, so a stored file whose size or
+    mtime changed is hashed again before it is reused, and dropped if it no
+    longer matches its digest.
+
+    Nothing is ever removed from the store otherwise. Its files can be
+    deleted at any time to reclaim space; served files keep their data.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.verified = {}
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def lookup(self, digest):
+        if not DIGEST_RE.fullmatch(digest):
+            return None
+        path = self.path(digest)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or not self.verify(digest, path, st):
+            return None
+        return path
+
+    def verify(self, digest, stored, st):
+        """Whether ``stored`` still holds ``digest``; drop it if not."""
+        validator = (st.st_size, st.st_mtime_ns)
+        if self.verified.get(digest) == validator:
+            return True
+        if file_digest(stored) == digest:
+            self.verified[digest] = validator
+            return True
+        logging.warning(f"stored upload {digest} was modified, dropping it")
+        self.verified.pop(digest, None)
+        try:
+            os.remove(stored)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def add(self, path, digest):
+        """Store ``path`` or replace it with the stored copy.
+
+        Returns True if ``path`` now shares its data with an earlier upload.
+        """
+        stored = self.path(digest)
+        with self.lock:
+            try:
+                st = os.stat(stored)
+            except FileNotFoundError:
+                st = None
+            if st is None or not self.verify(digest, stored, st):
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                if clone_file(path, stored):
+                    st = os.stat(stored)
+                    self.verified[digest] = (st.st_size, st.st_mtime_ns)
+                return False
+            fs = os.stat(path)
+            if st.st_size != fs.st_size or os.path.samestat(st, fs):
+                return False
+            tmp = os.path.join(
+                os.path.dirname(path), f"{UPLOAD_PREFIX}{uuid.uuid4().hex}.dedup"
+            )
+            if not clone_file(stored, tmp):
+                return False
+            os.replace(tmp, path)
+            return True
+
+    def link_into(self, digest, directory, name):
+        """Put a clone of the stored ``digest`` into ``directory``."""
+        stored = self.lookup(digest)
+        if stored is None:
+            return None
+        target = safe_save_path(directory, name)
+        if not clone_file(stored, target):
+            raise OSError(f"cannot link {stored} into {directory}")
+        return target
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 60)
+
+
+class Metrics:
+    """Prometheus-style counters, gauges and latency histograms.
+
+    Every thread records into its own shard, so the request path never
+    takes a lock; shards are only summed up when ``/_metrics`` is scraped.
+    Gauges are kept as +1/-1 counters, which sum correctly across shards.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+        self.last_scrape = (time.monotonic(), 0, 0)
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = ({}, {})
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def add(self, name, value=1, labels=()):
+        counters = self.shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        histograms = self.shard()[1]
+        key = (name, labels)
+        h = histograms.get(key)
+        if h is None:
+            # One slot per bucket, one for +Inf, then the sum.
+            h = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        h[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        h[-1] += value
+
+    def collect(self):
+        counters = {}
+        histograms = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard_counters, shard_histograms in shards:
+            for key, value in list(shard_counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, h in list(shard_histograms.items()):
+                total = histograms.setdefault(key, [0] * len(h))
+                for i, v in enumerate(list(h)):
+                    total[i] += v
+        return counters, histograms
+
+    def render(self):
+        counters, histograms = self.collect()
+
+        now = time.monotonic()
+        sent = sum(v for (n, _), v in counters.items() if n == "http_response_bytes")
+        received = sum(v for (n, _), v in counters.items() if n == "http_request_bytes")
+        last_time, last_sent, last_received = self.last_scrape
+        self.last_scrape = (now, sent, received)
+        elapsed = max(now - last_time, 1e-9)
+        counters[("http_send_throughput_bytes_per_second", ())] = (
+            sent - last_sent
+        ) / elapsed
+        counters[("http_receive_throughput_bytes_per_second", ())] = (
+            received - last_received
+        ) / elapsed
+
+        hits = counters.get(("http_file_cache_hits", ()), 0)
+        lookups = hits + counters.get(("http_file_cache_misses", ()), 0)
+        if lookups:
+            counters[("http_file_cache_hit_ratio", ())] = hits / lookups
+
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            kind = "counter" if name in METRIC_COUNTERS else "gauge"
+            metric = name + "_total" if kind == "counter" else name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric}{format_labels(labels)} {value}")
+        for (name, labels), h in sorted(histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for le, count in zip(LATENCY_BUCKETS + ("+Inf",), h):
+                cumulative += count
+                le_labels = labels + (("le", str(le)),)
+                lines.append(f"{name}_bucket{format_labels(le_labels)} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {h[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+METRIC_COUNTERS = {
+    "http_requests",
+    "http_response_bytes",
+    "http_request_bytes",
+    "http_file_cache_hits",
+    "http_file_cache_misses",
+    "http_rejected_connections",
+    "http_throttled_seconds",
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of blocking.
+
+    ``reserve`` takes the tokens at once, going into debt if needed, and
+    returns how long the caller has to wait before sending; callers queue up
+    behind each other's debt, which makes the bucket first come first served.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(rate / 4, COPY_BUFSIZE)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def reserve(self, n):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= n
+        return max(0.0, -self.tokens / self.rate)
+
+
+class ClientState:
+    def __init__(self):
+        self.connections = 0
+        self.downloads = 0
+        self.bucket = None
+
+
+class BandwidthShaper:
+    """Global and per-client download limits plus a per-client connection cap.
+
+    Clients with a download in flight share the global rate equally, so one
+    client pulling a large file cannot starve the others. Responses of at
+    most ``priority_bytes`` are charged but never delayed, up to
+    ``priority_bytes`` per client and ``PRIORITY_WINDOW``: small responses
+    such as listings go out at once, while a client splitting a download
+    into small Range requests is still held to its rate.
+    """
+
+    def __init__(self, rate=0, client_rate=0, max_connections=0, priority_bytes=0):
+        self.global_bucket = TokenBucket(rate) if rate else None
+        self.rate = rate
+        self.client_rate = client_rate
+        self.max_connections = max_connections
+        self.priority_bytes = priority_bytes
+        self.priority_windows = OrderedDict()
+        self.clients = {}
+        self.downloading = 0
+        self.lock = threading.Lock()
+
+    @property
+    def limited(self):
+        return bool(self.rate or self.client_rate)
+
+    def client(self, ip):
+        state = self.clients.get(ip)
+        if state is None:
+            state = self.clients[ip] = ClientState()
+        return state
+
+    def release(self, ip, state):
+        if not state.connections and not state.downloads:
+            del self.clients[ip]
+
+    def connect(self, ip):
+        with self.lock:
+            state = self.client(ip)
+            if self.max_connections and state.connections >= self.max_connections:
+                self.release(ip, state)
+                return False
+            state.connections += 1
+            return True
+
+    def disconnect(self, ip):
+        with self.lock:
+            state = self.client(ip)
+            state.connections -= 1
+            self.release(ip, state)
+
+    def start_download(self, ip):
+        with self.lock:
+            state = self.client(ip)
+            state.downloads += 1
+            if state.downloads == 1:
+                self.downloading += 1
+                self.rebalance()
+
+    def finish_download(self, ip):
+        with self.lock:
+            state = self.client(ip)
+            state.downloads -= 1
+            if not state.downloads:
+                self.downloading -= 1
+                state.bucket = None
+                self.rebalance()
+            self.release(ip, state)
+
+    def rebalance(self):
+        share = self.rate / max(self.downloading, 1) if self.rate else 0
+        if self.client_rate:
+            share = min(share, self.client_rate) if share else self.client_rate
+        if not share:
+            return
+        for state in self.clients.values():
+            if not state.downloads:
+                continue
+            if state.bucket is None:
+                state.bucket = TokenBucket(share)
+            else:
+                state.bucket.rate = share
+                state.bucket.burst = max(share / 4, COPY_BUFSIZE)
+
+    def grant_priority(self, ip, length):
+        """Whether a response of ``length`` bytes to ``ip`` may skip delays."""
+        if length > self.priority_bytes:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            windows = self.priority_windows
+            while windows:
+                oldest = next(iter(windows))
+                if now - windows[oldest][0] < PRIORITY_WINDOW:
+                    break
+                del windows[oldest]
+            started, left = windows.get(ip, (now, self.priority_bytes))
+            if length > left:
+                return False
+            windows[ip] = (started, left - length)
+            return True
+
+    def charge(self, ip, n, priority):
+        """Take ``n`` bytes from the buckets; return the seconds to wait."""
+        with self.lock:
+            delay = 0.0
+            if self.global_bucket:
+                delay = self.global_bucket.reserve(n)
+            state = self.clients.get(ip)
+            if state is not None and state.bucket is not None:
+                delay = max(delay, state.bucket.reserve(n))
+        return 0.0 if priority else delay
+
+
+def split_range(offset, count, size):
+    while count > 0:
+        n = min(count, size)
+        yield offset, n
+        offset += n
+        count -= n
+
+
+TOO_MANY_CONNECTIONS = (
+    b"HTTP/1.1 429 Too Many Requests\r\n"
+    b"Retry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+)
+
+
+class CachedFile(NamedTuple):
+    validator: tuple
+    headers: list
+    body: bytes
+    etag: str
+    mtime: float
+    last_modified: str
+    watched: bool
+
+
+class FileCache:
+    """Byte-budgeted LRU cache of small files with their response headers.
+
+    Entries are keyed on ``(path, negotiated encoding)`` and validated
+    against ``(st_mtime_ns, st_size)`` on every hit, unless an inotify
+    watcher covers their directory, which drops entries as soon as their
+    files change. Directories the watcher cannot cover (watch limit reached,
+    filesystem without inotify) fall back to stat validation.
+    """
+
+    def __init__(self, max_bytes, max_file_size, metrics):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.metrics = metrics
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.watch_failed = False
+
+    def enable_inotify(self):
+        try:
+            self.watcher = InotifyWatcher(self.invalidate)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify unavailable, validating by stat: {e}")
+
+    def get(self, path, encoding):
+        key = (path, encoding)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is not None and not entry.watched:
+            try:
+                st = os.stat(path)
+                if (st.st_mtime_ns, st.st_size) != entry.validator:
+                    entry = None
+            except OSError:
+                entry = None
+            if entry is None:
+                self.discard([key])
+        self.metrics.add(
+            "http_file_cache_misses" if entry is None else "http_file_cache_hits"
+        )
+        return entry
+
+    def watch(self, path):
+        """Watch the directory of ``path``; False if it must be validated by stat."""
+        if self.watcher is None:
+            return False
+        try:
+            self.watcher.watch(os.path.dirname(path))
+        except OSError as e:
+            if not self.watch_failed:
+                self.watch_failed = True
+                logging.warning(f"inotify cannot watch {path}, validating by stat: {e}")
+            return False
+        return True
+
+    def put(self, key, entry):
+        freed = 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                freed += len(old.body)
+            self.entries[key] = entry
+            while (
+                self.size + len(entry.body) - freed > self.max_bytes
+                and len(self.entries) > 1
+            ):
+                _, evicted = self.entries.popitem(last=False)
+                freed += len(evicted.body)
+            self.size += len(entry.body) - freed
+        self.metrics.add("http_file_cache_bytes", len(entry.body) - freed)
+
+    def discard(self, keys):
+        freed = 0
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    freed += len(entry.body)
+            self.size -= freed
+        if freed:
+            self.metrics.add("http_file_cache_bytes", -freed)
+
+    def invalidate(self, path):
+        """Drop entries for ``path``, everything under it, or all if None."""
+        with self.lock:
+            if path is None:
+                keys = list(self.entries)
+            else:
+                prefix = path.rstrip(os.sep) + os.sep
+                keys = [
+                    k for k in self.entries if k[0] == path or k[0].startswith(prefix)
+                ]
+        self.discard(keys)
+
+
+class InotifyWatcher:
+    """Reports changes in watched directories through Linux inotify."""
+
+    MASK = (
+        0x002  # IN_MODIFY
+        | 0x004  # IN_ATTRIB
+        | 0x008  # IN_CLOSE_WRITE
+        | 0x040  # IN_MOVED_FROM
+        | 0x080  # IN_MOVED_TO
+        | 0x100  # IN_CREATE
+        | 0x200  # IN_DELETE
+        | 0x400  # IN_DELETE_SELF
+        | 0x800  # IN_MOVE_SELF
+    )
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, on_change):
+        import ctypes
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.on_change = on_change
+        self.dirs = {}
+        self.wds = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, name="inotify", daemon=True).start()
+
+    def watch(self, directory):
+        with self.lock:
+            if directory in self.dirs:
+                return
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                import ctypes
+
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            self.dirs[directory] = wd
+            self.wds[wd] = directory
+
+    def run(self):
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    self.on_change(None)
+                    continue
+                with self.lock:
+                    directory = self.wds.get(wd)
+                    if directory is not None and mask & (
+                        self.IN_IGNORED | self.IN_MOVE_SELF
+                    ):
+                        del self.wds[wd]
+                        del self.dirs[directory]
+                        # A moved directory keeps its watch under the new
+                        # name; a new one made at the old path needs its own.
+                        if mask & self.IN_MOVE_SELF:
+                            self.libc.inotify_rm_watch(self.fd, wd)
+                if directory is None:
+                    continue
+                if name and not mask & self.IN_IGNORED:
+                    self.on_change(os.path.join(directory, os.fsdecode(name)))
+                else:
+                    self.on_change(directory)
+
+
+def make_etag(fs):
+    return f'"{fs.st_ino:x}-{fs.st_size:x}-{fs.st_mtime_ns:x}"'
+
+
+# More ranges than this, after merging, get the whole file (RFC 7233 6.1).
+MAX_RANGES = 32
+
+
+def parse_range(header, size):
+    """Parse a ``Range`` header into a list of ``(start, end)`` pairs.
+
+    ``end`` is inclusive. Overlapping and adjacent ranges are merged, in
+    order of their start. Returns None if the header is missing, malformed
+    or asks for more than ``MAX_RANGES`` ranges (the whole file should be
+    sent), and an empty list if no range can be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for item in spec.split(","):
+        first, sep, last = item.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and start > end:
+                    return None
+            else:
+                suffix = int(last)
+                start = max(size - suffix, 0)
+                end = size - 1
+                if suffix == 0:
+                    continue
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+class DirEntryInfo(NamedTuple):
+    name: str
+    is_dir: bool
+    size: int
+    mtime_ns: int
+
+
+def scan_directory(path):
+    """List ``path`` with a single ``os.scandir`` pass, sorted by name."""
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith(UPLOAD_PREFIX):
+                continue
+            try:
+                is_dir = entry.is_dir()
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append(DirEntryInfo(entry.name, is_dir, st.st_size, st.st_mtime_ns))
+    entries.sort(key=lambda e: e.name.lower())
+    return entries
+
+
+def render_listing_head(displaypath):
+    return f"""
+        <!DOCTYPE HTML>
+        <html>
+        <head>
+        <meta charset="utf-8">
+        <title>目录列表 - {displaypath}</title>
+        <style>
+            body {{ font-family: Arial, sans-serif; margin: 20px; }}
+            table {{ border-collapse: collapse; width: 100%; }}
+            th, td {{ text-align: left; padding: 8px; border-bottom: 1px solid #ddd; }}
+            tr:hover {{ background-color: #f5f5f5; }}
+            .folder {{ color: #0073e6; font-weight: bold; }}
+        </style>
+        </head>
+        <body>
+        <h2>目录列表: {displaypath}</h2>
+        <p>打包下载: <a href="?archive=zip">zip</a> <a href="?archive=tar">tar</a></p>
+        <form ENCTYPE="multipart/form-data" method="post">
+            <input name="file" type="file" multiple>
+            <input type="submit" value="上传文件">
+            <button type="button" onclick="chunkedUpload(this.form.file)">分块上传</button>
+            <span id="upload-progress"></span>
+        </form>
+        <script>{CHUNKED_UPLOAD_SCRIPT}</script>
+        <hr>
+        <table>
+            <tr>
+                <th>名称</th>
+                <th>大小</th>
+                <th>修改时间</th>
+            </tr>
+        """
+
+
+# Uploads each file as parallel PUT requests of fixed-size chunks, skipping
+# chunks the server already has, so an interrupted upload can be resumed.
+CHUNKED_UPLOAD_SCRIPT = """
+async function chunkedUpload(input) {
+    const chunkSize = 8 << 20, parallel = 4;
+    const progress = document.getElementById("upload-progress");
+    for (const file of input.files) {
+        let h = 2166136261;
+        for (const c of file.name) h = Math.imul(h ^ c.codePointAt(0), 16777619) >>> 0;
+        const id = [file.size, file.lastModified, h].map(n => n.toString(16)).join("-");
+        const start = await fetch(`?upload=${id}&name=${encodeURIComponent(file.name)}` +
+            `&size=${file.size}&chunk_size=${chunkSize}`, {method: "POST"});
+        if (!start.ok) throw new Error(await start.text());
+        const received = new Set((await start.json()).received);
+        const chunks = Math.ceil(file.size / chunkSize);
+        let next = 0, done = received.size;
+        async function worker() {
+            while (next < chunks) {
+                const i = next++;
+                if (received.has(i)) continue;
+                const offset = i * chunkSize;
+                for (let attempt = 1; ; attempt++) {
+                    const r = await fetch(`?upload=${id}&index=${i}&offset=${offset}`,
+                        {method: "PUT", body: file.slice(offset, offset + chunkSize)}).catch(e => e);
+                    if (r.ok) break;
+                    if (attempt == 3) throw new Error(`chunk ${i} of ${file.name} failed`);
+                }
+                progress.textContent = `${file.name}: ${++done} / ${chunks}`;
+            }
+        }
+        await Promise.all(Array.from({length: parallel}, worker));
+    }
+    location.reload();
+}
+"""
+LISTING_TAIL = "</table><hr></body></html>"
+LISTING_CHUNK_ROWS = 512
+# Rough memory taken by one scanned entry, its name and its sort orders.
+LISTING_ENTRY_BYTES = 256
+DEFAULT_PER_PAGE = 500
+
+
+def render_listing_row(entry):
+    displayname = linkname = entry.name
+    if entry.is_dir:
+        displayname = linkname = entry.name + "/"
+        size = "-"
+        cls = "folder"
+    else:
+        size = format_size(entry.size)
+        cls = "file"
+
+    mtime = datetime.fromtimestamp(entry.mtime_ns / 1e9).isoformat(timespec="seconds")
+    return f"""
+            <tr>
+                <td><a class="{cls}" href="{urllib.parse.quote(linkname)}">{html.escape(displayname)}</a></td>
+                <td>{size}</td>
+                <td>{mtime}</td>
+            </tr>
+            """
+
+
+class DirectoryListing:
+    """Scanned entries of one directory with their rendered table rows.
+
+    Rows are rendered on first use and kept, as are sort orders and the
+    full page (encoded, hashed and compressed per encoding), so an unchanged
+    directory is served straight from memory. Only the page of the last
+    display path is kept, so different URLs of one directory cannot pile up
+    copies of it.
+    """
+
+    sort_keys = {
+        "name": lambda e: e.name.lower(),
+        "size": lambda e: e.size,
+        "mtime": lambda e: e.mtime_ns,
+    }
+
+    def __init__(self, entries, rows):
+        self.entries = entries
+        self.rows = rows
+        self.rows_size = sum(map(len, rows.values()))
+        self.orders = {}
+        self.pages = (None, {})
+
+    def nbytes(self):
+        """Approximate memory held by the listing."""
+        _, variants = self.pages
+        return (
+            len(self.entries) * LISTING_ENTRY_BYTES
+            + self.rows_size
+            + sum(len(f) for f, _ in variants.values())
+        )
+
+    @classmethod
+    def build(cls, path, previous=None):
+        # Rows of entries that did not change since the previous scan are
+        # reused, so only new or modified entries get rendered again.
+        entries = scan_directory(path)
+        rows = {}
+        if previous is not None:
+            rows = {e: previous.rows[e] for e in entries if e in previous.rows}
+        return cls(entries, rows)
+
+    def row(self, entry):
+        row = self.rows.get(entry)
+        if row is None:
+            row = self.rows[entry] = render_listing_row(entry)
+            self.rows_size += len(row)
+        return row
+
+    def sorted(self, sort, reverse):
+        if sort == "name" and not reverse:
+            return self.entries
+        order = self.orders.get((sort, reverse))
+        if order is None:
+            order = sorted(self.entries, key=self.sort_keys[sort], reverse=reverse)
+            self.orders[(sort, reverse)] = order
+        return order
+
+    def iter_html(self, head, entries, tail):
+        yield head.encode("utf-8")
+        for i in range(0, len(entries), LISTING_CHUNK_ROWS):
+            batch = entries[i : i + LISTING_CHUNK_ROWS]
+            yield "".join(self.row(e) for e in batch).encode("utf-8")
+        yield tail.encode("utf-8")
+
+    def iter_page(self, displaypath):
+        """Stream the full page, and keep it for later requests once done."""
+        chunks = []
+        for chunk in self.iter_html(
+            render_listing_head(displaypath), self.entries, LISTING_TAIL
+        ):
+            chunks.append(chunk)
+            yield chunk
+        f = b"".join(chunks)
+        etag = '"{}"'.format(hashlib.blake2b(f, digest_size=12).hexdigest())
+        self.pages = (displaypath, {None: (f, etag)})
+
+    def page(self, displaypath, encoding=None):
+        """Return the cached full page and its ETag, or None if not cached.
+
+        The page is compressed once per encoding.
+        """
+        path, variants = self.pages
+        if path != displaypath:
+            return None
+        cached = variants.get(encoding)
+        if cached is None:
+            f, etag = variants[None]
+            cached = compress_bytes(f, encoding), variant_etag(etag, encoding)
+            variants[encoding] = cached
+        return cached
+
+
+def iter_listing_json(displaypath, entries, meta):
+    head = dict(meta, path=displaypath)
+    yield (json.dumps(head, ensure_ascii=False)[:-1] + ', "entries": [').encode()
+    for i in range(0, len(entries), LISTING_CHUNK_ROWS):
+        batch = entries[i : i + LISTING_CHUNK_ROWS]
+        items = ",".join(
+            json.dumps(
+                {
+                    "name": e.name,
+                    "type": "dir" if e.is_dir else "file",
+                    "size": e.size,
+                    "mtime": e.mtime_ns / 1e9,
+                },
+                ensure_ascii=False,
+            )
+            for e in batch
+        )
+        yield (("," if i else "") + items).encode("utf-8")
+    yield b"]}"
+
+
+def parse_listing_query(query):
+    """Validate listing query parameters, raising ValueError on bad input."""
+
+    def get(name, default):
+        return query.get(name, [default])[-1]
+
+    fmt = get("format", "html")
+    sort = get("sort", "name")
+    order = get("order", "asc")
+    if fmt not in ("html", "json"):
+        raise ValueError(f"format: {fmt}")
+    if sort not in DirectoryListing.sort_keys:
+        raise ValueError(f"sort: {sort}")
+    if order not in ("asc", "desc"):
+        raise ValueError(f"order: {order}")
+    page = int(get("page", 1))
+    per_page = get("per_page", None)
+    if per_page is None and "page" in query:
+        per_page = DEFAULT_PER_PAGE
+    per_page = int(per_page) if per_page is not None else None
+    if page < 1 or (per_page is not None and per_page < 1):
+        raise ValueError("page and per_page must be positive")
+    return fmt, sort, order == "desc", page, per_page
+
+
+def render_page_nav(query, page, pages):
+    def link(n, text):
+        params = dict(query, page=[str(n)])
+        href = "?" + urllib.parse.urlencode(params, doseq=True)
+        return f'<a href="{html.escape(href)}">{text}</a>'
+
+    nav = []
+    if page > 1:
+        nav.append(link(page - 1, "上一页"))
+    nav.append(f"{page} / {pages}")
+    if page < pages:
+        nav.append(link(page + 1, "下一页"))
+    return "<p>" + " ".join(nav) + "</p>"
+
+
+class ListingCache:
+    """LRU cache of DirectoryListing objects keyed on the directory's mtime.
+
+    Adding, removing or renaming an entry bumps the directory mtime and
+    triggers a rescan; in-place changes to a file's content do not. At most
+    ``max_entries`` listings are kept, using about ``max_bytes`` in total.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        st = os.stat(path)
+        key = (st.st_ino, st.st_mtime_ns)
+        with self.lock:
+            cached = self.entries.get(path)
+            if cached is not None:
+                self.entries.move_to_end(path)
+                if cached[0] == key:
+                    # Pages and rows are added after a listing is stored
+                    self.trim()
+                    return cached[1]
+        listing = DirectoryListing.build(path, cached and cached[1])
+        with self.lock:
+            self.entries[path] = (key, listing)
+            self.entries.move_to_end(path)
+            self.trim()
+        return listing
+
+    def trim(self):
+        size = sum(listing.nbytes() for _, listing in self.entries.values())
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.max_entries or size > self.max_bytes
+        ):
+            _, (_, evicted) = self.entries.popitem(last=False)
+            size -= evicted.nbytes()
+
+
+def frame_chunk(chunk):
+    return b"%x\r\n%s\r\n" % (len(chunk), chunk)
+
+
+LAST_CHUNK = b"0\r\n\r\n"
+
+
+def close_body(body):
+    if hasattr(body, "close"):
+        body.close()
+
+
+class CustomRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without TCP_NODELAY
+    # keep-alive responses stall on delayed ACKs.
+    disable_nagle_algorithm = True
+    timeout = 10
+    compress_cache = None
+    listing_cache = ListingCache()
+    uploads = UploadRegistry()
+    metrics = Metrics()
+    file_cache = None
+    shaper = None
+    content_store = None
+    # The asyncio engine records a request only after streaming its body.
+    record_on_finish = True
+    # Set when an idle keep-alive connection is handed back to the server.
+    parked = False
+
+    def log_message(self, format, *args):
+        """Disable default HTTP server logging."""
+        pass
+
+    def handle(self):
+        """Serve requests until the connection closes or goes idle.
+
+        If the server can watch idle connections, a keep-alive connection
+        with no request pending is parked with it instead of holding a
+        worker until the next request or the idle timeout.
+        """
+        self.parked = False
+        self.handle_one_request()
+        can_park = hasattr(self.server, "park")
+        while not self.close_connection:
+            if (
+                can_park
+                and not self.request_pending()
+                and not self.server.await_request(self.connection)
+            ):
+                self.parked = True
+                return
+            self.handle_one_request()
+
+    def request_pending(self):
+        """Whether part of the next request is already buffered or readable."""
+        import ssl
+
+        conn = self.connection
+        if isinstance(conn, ssl.SSLSocket) and conn.pending():
+            return True
+        conn.setblocking(False)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except (BlockingIOError, ssl.SSLWantReadError):
+            pass
+        except OSError:
+            # Let the next read report it.
+            return True
+        finally:
+            conn.settimeout(self.timeout)
+        return False
+
+    def resume(self):
+        """Continue serving a parked connection that became readable."""
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def finish(self):
+        if not self.parked:
+            super().finish()
+
+    def handle_one_request(self):
+        self.response_status = None
+        self.request_started = None
+        self.first_byte_at = None
+        self.bytes_sent = 0
+        self.priority = False
+        super().handle_one_request()
+        if self.record_on_finish:
+            self.record_request()
+
+    def parse_request(self):
+        self.request_started = time.perf_counter()
+        if not super().parse_request():
+            return False
+        # Only POST and PUT read a body, and never a chunked one; anything
+        # left unread would be parsed as the next request on the connection.
+        if "Transfer-Encoding" in self.headers or (
+            self.command not in ("POST", "PUT") and self.has_body()
+        ):
+            self.close_connection = True
+        return True
+
+    def has_body(self):
+        return self.headers.get("Content-Length", "0").strip() != "0"
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
 
+    def send_header(self, keyword, value):
+        if (
+            keyword.lower() == "content-length"
+            and self.command != "HEAD"
+            and self.shaper is not None
+            and self.shaper.limited
+        ):
+            self.priority = self.shaper.grant_priority(
+                self.client_address[0], int(value)
+            )
+        super().send_header(keyword, value)
 
-class CustomRequestHandler(BaseHTTPRequestHandler):
-    extensions_map = init_mimetypes()
+    def end_headers(self):
+        super().end_headers()
+        if self.first_byte_at is None:
+            self.first_byte_at = time.perf_counter()
 
-    def log_message(self, format, *args):
-        """Disable default HTTP server logging."""
-        pass
+    def record_request(self):
+        if self.response_status is None:
+            return
+        now = time.perf_counter()
+        started = self.request_started or now
+        labels = (("method", self.command or "-"), ("status", self.response_status))
+        self.metrics.add("http_requests", 1, labels)
+        self.metrics.add("http_response_bytes", self.bytes_sent, labels)
+        if self.command in ("POST", "PUT"):
+            received = int(self.headers.get("Content-Length") or 0)
+            self.metrics.add("http_request_bytes", received, labels)
+        self.metrics.observe("http_request_duration_seconds", now - started, labels)
+        self.metrics.observe(
+            "http_time_to_first_byte_seconds",
+            (self.first_byte_at or now) - started,
+            labels,
+        )
 
     def do_GET(self):
-        f = self.send_head()
-        if f:
-            self.wfile.write(f)
+        body = self.send_head()
+        if body:
+            self.metrics.add("http_inflight_downloads", 1)
+            if self.shaper:
+                self.shaper.start_download(self.client_address[0])
+            try:
+                self.write_body(body)
+            finally:
+                close_body(body)
+                self.metrics.add("http_inflight_downloads", -1)
+                if self.shaper:
+                    self.shaper.finish_download(self.client_address[0])
 
     def do_HEAD(self):
-        self.send_head()
+        close_body(self.send_head())
+
+    def write_body(self, body):
+        if isinstance(body, bytes):
+            self.pace(len(body))
+            self.wfile.write(body)
+            self.bytes_sent += len(body)
+            return
+        if not isinstance(body, FileBody):
+            for chunk in body:
+                if chunk:
+                    self.pace(len(chunk))
+                    self.wfile.write(frame_chunk(chunk) if self.chunked else chunk)
+                    self.bytes_sent += len(chunk)
+            if self.chunked:
+                self.wfile.write(LAST_CHUNK)
+            return
+        for segment in body.segments:
+            if isinstance(segment, bytes):
+                self.pace(len(segment))
+                self.wfile.write(segment)
+                self.bytes_sent += len(segment)
+            else:
+                for piece in self.shaped_pieces(*segment):
+                    self.pace(piece[1])
+                    self.copyfile(body.f, *piece)
+                self.bytes_sent += segment[1]
+
+    def throttle(self, n):
+        """Charge ``n`` response bytes to the shaper; return the delay."""
+        if self.shaper is None or not self.shaper.limited:
+            return 0.0
+        delay = self.shaper.charge(self.client_address[0], n, self.priority)
+        if delay:
+            self.metrics.add("http_throttled_seconds", delay)
+        return delay
+
+    def pace(self, n):
+        delay = self.throttle(n)
+        if delay:
+            time.sleep(delay)
+
+    def shaped_pieces(self, offset, count):
+        """Split a file range so that rate limits apply while it is sent."""
+        if self.shaper is None or not self.shaper.limited:
+            return [(offset, count)]
+        return split_range(offset, count, COPY_BUFSIZE)
+
+    def copyfile(self, f, offset, count):
+        """Copy ``count`` bytes of ``f`` from ``offset`` to the client.
+
+        Uses ``sendfile`` (zero-copy) when the connection is a plain socket,
+        otherwise a fixed-size chunked copy, so memory stays bounded.
+        """
+        import ssl
+
+        self.wfile.flush()
+        if isinstance(self.connection, ssl.SSLSocket):
+            if self.copyfile_mmap(f, offset, count):
+                return
+        elif isinstance(self.connection, socket.socket):
+            self.connection.sendfile(f, offset, count)
+            return
+        f.seek(offset)
+        buf = memoryview(bytearray(COPY_BUFSIZE))
+        while count > 0:
+            n = f.readinto(buf[: min(count, COPY_BUFSIZE)])
+            if not n:
+                break
+            self.wfile.write(buf[:n])
+            count -= n
+
+    def copyfile_mmap(self, f, offset, count):
+        """Send a file range over TLS straight from a memory map.
+
+        ``sendfile`` would bypass encryption, so the file is mapped and large
+        ``memoryview`` slices are handed to ``SSLSocket.sendall`` without any
+        intermediate copy. Returns False if the file cannot be mapped.
+        """
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return False
+        with m, memoryview(m) as view:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            end = min(offset + count, len(m))
+            while offset < end:
+                n = min(TLS_WRITE_SIZE, end - offset)
+                self.connection.sendall(view[offset : offset + n])
+                offset += n
+        return True
+
+    def do_PUT(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = self.translate_path(self.path)
+        upload_id = query.get("upload", [""])[-1]
+        session = None
+        if UPLOAD_ID_RE.fullmatch(upload_id):
+            session = self.uploads.get(path, upload_id)
+        if session is None:
+            self.close_connection = True
+            self.send_error(404, "Unknown upload")
+            return
+        try:
+            index = int(query["index"][-1])
+            offset = int(query.get("offset", [index * session.chunk_size])[-1])
+            length = int(self.headers["Content-Length"])
+        except (KeyError, TypeError, ValueError):
+            index = offset = length = -1
+        if (
+            not 0 <= index < session.chunks
+            or offset != index * session.chunk_size
+            or length != session.chunk_length(index)
+        ):
+            self.close_connection = True
+            self.send_error(400, "Invalid chunk")
+            return
+        self.metrics.add("http_inflight_uploads", 1)
+        try:
+            session.write_chunk(index, self.rfile, length)
+        except OSError as e:
+            self.close_connection = True
+            self.send_error(500, f"Chunk write failed: {e}")
+            return
+        finally:
+            self.metrics.add("http_inflight_uploads", -1)
+        self.wfile.write(self.send_json(session.status()))
+
+    def start_chunked_upload(self, path, query):
+        def get(name):
+            return query.get(name, [""])[-1]
+
+        upload_id = get("upload")
+        name = os.path.basename(get("name"))
+        try:
+            size = int(get("size"))
+            chunk_size = int(get("chunk_size"))
+        except ValueError:
+            size = chunk_size = -1
+        if (
+            not UPLOAD_ID_RE.fullmatch(upload_id)
+            or not name
+            or size < 0
+            or not 0 < chunk_size <= MAX_CHUNK_SIZE
+        ):
+            self.send_error(400, "Invalid upload")
+            return
+        try:
+            session = self.uploads.start(path, upload_id, name, size, chunk_size)
+        except UploadRejected as e:
+            self.send_error(*e.args)
+            return
+        except OSError as e:
+            self.send_error(500, f"Cannot start upload: {e}")
+            return
+        self.wfile.write(self.send_json(session.status()))
+
+    def link_stored_upload(self, path, query):
+        """Create ``name`` from content already in the store, skipping an upload."""
+        digest = query["hash"][-1]
+        name = os.path.basename(query.get("name", [""])[-1])
+        if not DIGEST_RE.fullmatch(digest) or not name:
+            self.send_error(400, "Invalid hash or name")
+            return
+        if not os.path.isdir(path):
+            self.send_error(404, "Directory not found")
+            return
+        try:
+            target = self.content_store and self.content_store.link_into(
+                digest, path, name
+            )
+        except OSError as e:
+            self.send_error(500, f"Cannot link stored file: {e}")
+            return
+        if not target:
+            self.send_error(404, "Unknown hash")
+            return
+        logging.info(f"linked stored upload: {target}")
+        self.wfile.write(
+            self.send_json({"hash": digest, "path": os.path.basename(target)})
+        )
+
+    def send_json(self, obj, status=200):
+        f = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(f)))
+        self.end_headers()
+        return f
 
     def do_POST(self):
-        r, info = self.deal_post_data()
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        if "upload" in query:
+            # The body of an upload start request, if any, is ignored.
+            if self.has_body():
+                self.close_connection = True
+            self.start_chunked_upload(self.translate_path(self.path), query)
+            return
+        if "hash" in query:
+            if self.has_body():
+                self.close_connection = True
+            self.link_stored_upload(self.translate_path(self.path), query)
+            return
+
+        self.metrics.add("http_inflight_uploads", 1)
+        try:
+            r, info = self.deal_post_data()
+        finally:
+            self.metrics.add("http_inflight_uploads", -1)
 
         logging.info(info)
         logging.info("uploaded by: {}".format(self.client_address))
@@ -120,75 +2055,89 @@ class CustomRequestHandler(BaseHTTPRequestHandler):
     def deal_post_data(self):
         content_type = self.headers.get("Content-Type", "")
         if not content_type or "boundary=" not in content_type:
+            self.close_connection = True
             return False, "Content-Type header missing or invalid boundary"
-        boundary = content_type.split("boundary=")[1]
-
-        boundary_begin = ("--" + boundary + "\r\n").encode("utf-8")
-        boundary_end = ("--" + boundary + "--\r\n").encode("utf-8")
+        boundary = content_type.split("boundary=")[1].split(";")[0].strip('"')
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.close_connection = True
+            return False, "Content-Length header missing or invalid"
 
-        return_status = True
+        reader = MultipartReader(self.rfile, boundary.encode("utf-8"), length)
+        path = self.translate_path(self.path)
         return_info = ""
-        loop_info = LoopInfo.OUTER
-
-        line = self.rfile.readline()
-
-        while loop_info == LoopInfo.OUTER:
-            if line != boundary_begin:
-                return_status = False
-                return_info += "Content NOT begin with boundary\n"
-                break
-
-            line = self.rfile.readline().decode("utf-8").rstrip("\r\n")
-            filename_match = re.findall(r'filename="(.*)"', line)
-            if not filename_match:
-                return_status = False
-                return_info += "Can't find out file name...\n"
-                loop_info = LoopInfo.LEAVE
-                break
-            fn = filename_match[0]
-            path = self.translate_path(self.path)
-            filename = safe_save_path(path, fn)
-
-            line = self.rfile.readline()
-            line = self.rfile.readline()
-            loop_info = LoopInfo.INNER
-
-            try:
-                with open(filename, "wb") as f:
-                    buf = bytearray(8192)
-                    while loop_info == LoopInfo.INNER:
-                        line = self.rfile.readline()
-                        if line == boundary_begin:
-                            loop_info = LoopInfo.OUTER
-                            if buf:
-                                f.write(buf)
-                            break
-                        elif line == boundary_end:
-                            loop_info = LoopInfo.LEAVE
-                            if buf:
-                                f.write(buf)
-                            break
-                        else:
-                            buf.extend(line)
-                            if len(buf) > 8192:
-                                f.write(buf)
-                                buf.clear()
-            except Exception as e:
-                loop_info = LoopInfo.LEAVE
-                return_status = False
-                return_info += f"Exception: {e}\n"
-            return_info += filename
-        return (return_status, return_info)
+        try:
+            while True:
+                headers = reader.next_part()
+                if headers is None:
+                    break
+                disposition = headers.get("content-disposition", "")
+                filename_match = re.findall(r'filename="(.*)"', disposition)
+                if not filename_match:
+                    raise MultipartError("Can't find out file name...")
+                fn = os.path.basename(filename_match[0])
+                if not fn:
+                    reader.copy_to(None)
+                    continue
+                filename = safe_save_path(path, fn)
+                try:
+                    with open(filename, "wb") as f:
+                        out = HashingWriter(f)
+                        reader.copy_to(out)
+                except BaseException:
+                    os.remove(filename)
+                    raise
+                digest = out.hash.hexdigest()
+                return_info += f"{filename} blake2b={digest}"
+                if self.content_store and self.content_store.add(filename, digest):
+                    return_info += " (deduplicated)"
+                return_info += "\n"
+        except (MultipartError, OSError) as e:
+            self.close_connection = True
+            return False, return_info + f"Exception: {e}\n"
+        return True, return_info
 
     def send_head(self):
+        self.chunked = False
+        if urllib.parse.urlsplit(self.path).path == "/_metrics":
+            f = self.metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(f)))
+            self.end_headers()
+            return f
         path = self.translate_path(self.path)
+        cached = self.lookup_cached_file(path)
+        if cached is not None:
+            return self.send_cached_file(cached)
         f = None
         if os.path.isdir(path):
-            if not self.path.endswith("/"):
+            url = urllib.parse.urlsplit(self.path)
+            if not url.path.endswith("/"):
                 self.send_response(301)
-                self.send_header("Location", self.path + "/")
+                location = url._replace(path=url.path + "/")
+                self.send_header("Location", urllib.parse.urlunsplit(location))
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
+            query = urllib.parse.parse_qs(url.query)
+            if "upload" in query:
+                session = None
+                upload_id = query["upload"][-1]
+                if UPLOAD_ID_RE.fullmatch(upload_id):
+                    session = self.uploads.get(path, upload_id)
+                if session is None:
+                    self.send_error(404, "Unknown upload")
+                    return None
+                return self.send_json(session.status())
+            if "hash" in query:
+                digest = query["hash"][-1]
+                stored = self.content_store and self.content_store.lookup(digest)
+                status = {"algorithm": "blake2b", "hash": digest, "found": False}
+                if stored:
+                    status.update(found=True, size=os.path.getsize(stored))
+                return self.send_json(status)
             for index in ["index.html", "index.htm"]:
                 index = os.path.join(path, index)
                 if os.path.exists(index):
@@ -196,91 +2145,349 @@ class CustomRequestHandler(BaseHTTPRequestHandler):
                     break
             else:
                 return self.list_directory(path)
+            cached = self.lookup_cached_file(path)
+            if cached is not None:
+                return self.send_cached_file(cached)
         ctype = self.guess_type(path)
         try:
-            with open(path, "rb") as f:
-                self.send_response(200)
-                self.send_header("Content-Type", ctype)
-                fs = os.fstat(f.fileno())
-                self.send_header("Content-Length", str(fs[6]))
-                self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-                self.end_headers()
-                return f.read()
+            f = open(path, "rb")
         except IOError:
             self.send_error(404, "File not found")
             return None
+        try:
+            fs = os.fstat(f.fileno())
+            encoding = None
+            if fs.st_size >= MIN_COMPRESS_SIZE and "Range" not in self.headers:
+                encoding = self.choose_encoding(ctype)
+            etag = variant_etag(make_etag(fs), encoding)
+            last_modified = self.date_time_string(fs.st_mtime)
+            if self.is_not_modified(etag, fs.st_mtime):
+                f.close()
+                self.send_not_modified(etag, last_modified)
+                return None
+            if (
+                self.file_cache is not None
+                and stat.S_ISREG(fs.st_mode)
+                and fs.st_size <= self.file_cache.max_file_size
+                and "Range" not in self.headers
+            ):
+                cached = self.cache_file(f, path, fs, ctype, encoding, etag)
+                return self.send_cached_file(cached)
+            if encoding:
+                return self.send_compressed(f, path, fs, ctype, encoding, etag)
+
+            ranges = None
+            if_range = self.headers.get("If-Range")
+            if if_range is None or if_range in (etag, last_modified):
+                ranges = parse_range(self.headers.get("Range"), fs.st_size)
+            if ranges == []:
+                f.close()
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{fs.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+
+            if ranges is None:
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                segments = [(0, fs.st_size)]
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{fs.st_size}")
+                segments = [(start, end - start + 1)]
+            else:
+                boundary = uuid.uuid4().hex
+                segments = []
+                for start, end in ranges:
+                    part_head = (
+                        f"\r\n--{boundary}\r\n"
+                        f"Content-Type: {ctype}\r\n"
+                        f"Content-Range: bytes {start}-{end}/{fs.st_size}\r\n\r\n"
+                    )
+                    segments.append(part_head.encode("latin-1"))
+                    segments.append((start, end - start + 1))
+                segments.append(f"\r\n--{boundary}--\r\n".encode("latin-1"))
+                self.send_response(206)
+                self.send_header(
+                    "Content-Type", f"multipart/byteranges; boundary={boundary}"
+                )
+
+            length = sum(
+                len(seg) if isinstance(seg, bytes) else seg[1] for seg in segments
+            )
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            if is_compressible(ctype):
+                self.send_header("Vary", "Accept-Encoding")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return FileBody(f, segments)
+        except Exception:
+            f.close()
+            raise
+
+    def lookup_cached_file(self, path):
+        if self.file_cache is None or "Range" in self.headers:
+            return None
+        return self.file_cache.get(path, self.choose_encoding(self.guess_type(path)))
+
+    def cache_file(self, f, path, fs, ctype, encoding, etag):
+        watched = self.file_cache.watch(path)
+        with f:
+            body = f.read()
+        try:
+            st = os.stat(path)
+            unchanged = (st.st_mtime_ns, st.st_size) == (fs.st_mtime_ns, fs.st_size)
+        except OSError:
+            unchanged = False
+        last_modified = self.date_time_string(fs.st_mtime)
+        headers = [("Content-Type", ctype)]
+        if is_compressible(ctype):
+            headers.append(("Vary", "Accept-Encoding"))
+        if encoding:
+            body = compress_bytes(body, encoding)
+            headers.append(("Content-Encoding", encoding))
+        else:
+            headers.append(("Accept-Ranges", "bytes"))
+        headers += [
+            ("Content-Length", str(len(body))),
+            ("ETag", etag),
+            ("Last-Modified", last_modified),
+        ]
+        cached = CachedFile(
+            (fs.st_mtime_ns, fs.st_size),
+            headers,
+            body,
+            etag,
+            fs.st_mtime,
+            last_modified,
+            watched,
+        )
+        # A file changed while it was read is served once but not cached
+        if unchanged:
+            self.file_cache.put((path, self.choose_encoding(ctype)), cached)
+        return cached
+
+    def send_cached_file(self, cached):
+        if self.is_not_modified(cached.etag, cached.mtime):
+            self.send_not_modified(cached.etag, cached.last_modified)
+            return None
+        self.send_response(200)
+        for name, value in cached.headers:
+            self.send_header(name, value)
+        self.end_headers()
+        return cached.body
+
+    def choose_encoding(self, ctype):
+        if not is_compressible(ctype):
+            return None
+        accepted = {}
+        for item in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = item.partition(";")
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            accepted[name.strip().lower()] = q
+        for encoding in ENCODINGS:
+            if accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+        return None
+
+    def send_compressed(self, f, path, fs, ctype, encoding, etag):
+        """Send ``f`` compressed, from a sidecar or cache file when possible.
+
+        A ``.gz``/``.br``/``.zst`` file next to the original is used if it is
+        at least as new; otherwise the compress cache directory is consulted,
+        and on a miss the file is compressed on the fly (and cached). Cache
+        files are named after the path alone, so a new version overwrites the
+        old one, and carry the mtime of the version they were made from.
+        """
+        suffix = ENCODING_SUFFIXES[encoding]
+        candidates = [path + suffix]
+        cache_path = None
+        if self.compress_cache:
+            key = hashlib.blake2b(path.encode(), digest_size=16)
+            cache_path = os.path.join(self.compress_cache, key.hexdigest() + suffix)
+            candidates.append(cache_path)
+        for candidate in candidates:
+            try:
+                cf = open(candidate, "rb")
+            except OSError:
+                continue
+            cs = os.fstat(cf.fileno())
+            if candidate == cache_path:
+                stale = cs.st_mtime_ns != fs.st_mtime_ns
+            else:
+                stale = cs.st_mtime_ns < fs.st_mtime_ns
+            if stale:
+                cf.close()
+                continue
+            f.close()
+            f = cf
+            break
+        else:
+            cs = None
+
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        if cs is not None:
+            self.send_header("Content-Length", str(cs.st_size))
+            self.end_headers()
+            return FileBody(f, [(0, cs.st_size)])
+        self.start_stream()
+        self.end_headers()
+        return CompressedFileBody(f, encoding, cache_path)
+
+    def is_not_modified(self, etag, mtime):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags or "W/" + etag in tags
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since.timestamp()
+
+    def send_not_modified(self, etag, last_modified=None):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        if last_modified:
+            self.send_header("Last-Modified", last_modified)
+        self.end_headers()
 
     def list_directory(self, path):
         try:
-            file_list = os.listdir(path)
-        except os.error:
+            listing = self.listing_cache.get(path)
+        except OSError:
             self.send_error(404, "没有权限列出目录")
             return None
 
-        file_list.sort(key=lambda a: a.lower())
-        displaypath = html.escape(urllib.parse.unquote(self.path))
+        url = urllib.parse.urlsplit(self.path)
+        # "/a/../b/", "//b/" and "/b/" list the same directory: one page
+        urlpath = posixpath.normpath("/" + urllib.parse.unquote(url.path).lstrip("/"))
+        urlpath = urlpath.rstrip("/") + "/"
+        displaypath = html.escape(urlpath)
+        query = urllib.parse.parse_qs(url.query)
+        if not query:
+            return self.send_listing_page(listing, displaypath)
+        if "archive" in query:
+            return self.send_archive(path, query["archive"][-1])
 
-        f = f"""
-        <!DOCTYPE HTML>
-        <html>
-        <head>
-        <meta charset="utf-8">
-        <title>目录列表 - {displaypath}</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 20px; }}
-            table {{ border-collapse: collapse; width: 100%; }}
-            th, td {{ text-align: left; padding: 8px; border-bottom: 1px solid #ddd; }}
-            tr:hover {{ background-color: #f5f5f5; }}
-            .folder {{ color: #0073e6; font-weight: bold; }}
-        </style>
-        </head>
-        <body>
-        <h2>目录列表: {displaypath}</h2>
-        <form ENCTYPE="multipart/form-data" method="post">
-            <input name="file" type="file" multiple>
-            <input type="submit" value="上传文件">
-        </form>
-        <hr>
-        <table>
-            <tr>
-                <th>名称</th>
-                <th>大小</th>
-                <th>修改时间</th>
-            </tr>
-        """
+        try:
+            fmt, sort, reverse, page, per_page = parse_listing_query(query)
+        except ValueError as e:
+            self.send_error(400, f"Invalid listing query: {e}")
+            return None
+        entries = listing.sorted(sort, reverse)
+        total = len(entries)
+        pages = 1
+        if per_page is not None:
+            pages = max(-(-total // per_page), 1)
+            entries = entries[(page - 1) * per_page : page * per_page]
 
-        for name in file_list:
-            fullname = os.path.join(path, name)
-            displayname = linkname = name
-            if os.path.isdir(fullname):
-                displayname = name + "/"
-                linkname = name + "/"
-                size = "-"
-                cls = "folder"
-            else:
-                size = os.path.getsize(fullname)
-                size = format_size(size)
-                cls = "file"
+        self.send_response(200)
+        if fmt == "json":
+            ctype = "application/json"
+            meta = {"total": total, "page": page, "per_page": per_page}
+            body = iter_listing_json(urlpath, entries, meta)
+            self.send_header("Content-Type", ctype + "; charset=utf-8")
+        else:
+            ctype = "text/html"
+            nav = render_page_nav(query, page, pages) if pages > 1 else ""
+            body = listing.iter_html(
+                render_listing_head(displaypath),
+                entries,
+                "</table>" + nav + "<hr></body></html>",
+            )
+            self.send_header("Content-Type", ctype)
+        body = self.compress_stream(body, ctype)
+        self.start_stream()
+        self.end_headers()
+        return body
 
-            mtime = os.path.getmtime(fullname)
-            mtime = datetime.fromtimestamp(mtime).isoformat(timespec="seconds")
-            f += f"""
-            <tr>
-                <td><a class="{cls}" href="{urllib.parse.quote(linkname)}">{html.escape(displayname)}</a></td>
-                <td>{size if size != '-' else '-'}</td>
-                <td>{mtime}</td>
-            </tr>
-            """
+    def compress_stream(self, body, ctype):
+        encoding = self.choose_encoding(ctype)
+        self.send_header("Vary", "Accept-Encoding")
+        if not encoding:
+            return body
+        self.send_header("Content-Encoding", encoding)
+        return compress_chunks(body, encoding)
 
-        f += "</table><hr></body></html>"
-        f = f.encode("utf-8")
+    def send_archive(self, path, kind):
+        if kind not in ARCHIVE_TYPES or (kind == "tar.zst" and "zstd" not in ENCODINGS):
+            self.send_error(400, f"Unsupported archive type: {kind}")
+            return None
+        if kind == "zip":
+            body = iter_zip(path)
+        else:
+            body = iter_tar(path)
+            if kind == "tar.zst":
+                body = compress_chunks(body, "zstd")
+        name = os.path.basename(path.rstrip(os.sep)) or "archive"
+        filename = urllib.parse.quote(f"{name}.{kind}")
+        self.send_response(200)
+        self.send_header("Content-Type", ARCHIVE_TYPES[kind])
+        self.send_header(
+            "Content-Disposition", f"attachment; filename*=UTF-8''{filename}"
+        )
+        self.start_stream()
+        self.end_headers()
+        return body
+
+    def send_listing_page(self, listing, displaypath):
+        encoding = self.choose_encoding("text/html")
+        cached = listing.page(displaypath, encoding)
+        if cached is None:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            body = self.compress_stream(listing.iter_page(displaypath), "text/html")
+            self.start_stream()
+            self.end_headers()
+            return body
+
+        f, etag = cached
+        if self.headers.get("If-None-Match") and self.is_not_modified(etag, 0):
+            self.send_not_modified(etag)
+            return None
         length = len(f)
         self.send_response(200)
+        self.send_header("ETag", etag)
         self.send_header("Content-Type", "text/html")
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
         self.send_header("Content-Length", str(length))
         self.end_headers()
         return f
 
+    def start_stream(self):
+        """Announce a body of unknown length.
+
+        HTTP/1.1 clients get chunked transfer encoding; older ones get a
+        body delimited by closing the connection.
+        """
+        if self.request_version >= "HTTP/1.1":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.chunked = True
+        else:
+            self.close_connection = True
+
     def translate_path(self, path):
         path = path.split("?", 1)[0]
         path = path.split("#", 1)[0]
@@ -299,18 +2506,649 @@ class CustomRequestHandler(BaseHTTPRequestHandler):
     def guess_type(self, path):
         _, ext = posixpath.splitext(path)
         ext_lower = ext.lower()
-        return self.extensions_map.get(ext_lower, "application/octet-stream")
+        # The MIME table is loaded on first use, not at startup.
+        return init_mimetypes().get(ext_lower, "application/octet-stream")
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer that serves connections on a fixed pool of worker threads.
+
+    Connections beyond the pool size wait in the executor queue, so the thread
+    count stays at ``workers`` however many clients connect. Connections
+    waiting for a request, new or keep-alive, are watched by one selector
+    thread and take no worker. Listens on IPv6 and IPv4 where the platform
+    allows one socket for both.
+    """
+
+    # Bursts of new clients must not overflow the accept queue and wait on
+    # SYN retransmits.
+    request_queue_size = socket.SOMAXCONN
+
+    def server_bind(self):
+        if self.address_family == socket.AF_INET6:
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        super().server_bind()
+
+    def __init__(self, server_address, handler_class, workers):
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Probed here rather than at import, as it opens a socket.
+        if socket.has_dualstack_ipv6():
+            self.address_family = socket.AF_INET6
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="http-worker"
+        )
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+        # Connections waiting for a request are watched here, not on a worker.
+        self.idle = selectors.DefaultSelector()
+        self.parking = []
+        self.draining = []
+        self.parking_lock = threading.Lock()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.idle.register(self.wakeup, selectors.EVENT_READ)
+        self.watching = True
+        threading.Thread(target=self.watch_idle, name="http-idle", daemon=True).start()
+
+    def process_request(self, request, client_address):
+        shaper = self.RequestHandlerClass.shaper
+        if shaper and not shaper.connect(client_address[0]):
+            self.reject_request(request)
+            return
+        self.RequestHandlerClass.metrics.add("http_active_connections", 1)
+        # Connections get a worker once their first request arrives, so
+        # ones opened ahead of use (as browsers do) do not hold the pool.
+        self.park(request, client_address)
+
+    def process_request_thread(self, request, client_address, handler=None):
+        import ssl
+
+        if isinstance(request, ssl.SSLSocket) and request.version() is None:
+            # Finish the TLS handshake, then wait for the first request off
+            # the pool again unless it came in with the handshake.
+            try:
+                request.settimeout(self.RequestHandlerClass.timeout)
+                request.do_handshake()
+            except (OSError, ValueError):
+                self.end_connection(request, client_address)
+                return
+            if not request.pending():
+                self.park(request, client_address)
+                return
+        try:
+            if handler is None:
+                handler = self.RequestHandlerClass(request, client_address, self)
+            else:
+                handler.resume()
+        except Exception:
+            if handler is not None:
+                handler.parked = False
+            self.handle_error(request, client_address)
+        if handler is not None and handler.parked:
+            self.park(request, client_address, handler)
+        else:
+            self.end_connection(request, client_address)
+
+    def await_request(self, conn):
+        """Keep a worker on a keep-alive connection for a moment, as clients
+        often follow up at once, while no other connection waits for one."""
+        # poll, unlike select, takes descriptors above FD_SETSIZE
+        poller = select.poll()
+        poller.register(conn, select.POLLIN)
+        waited = 0.0
+        while waited < KEEPALIVE_GRACE and not self.queued:
+            if poller.poll(KEEPALIVE_POLL * 1000):
+                return True
+            waited += KEEPALIVE_POLL
+        return False
+
+    def submit(self, fn, *args):
+        """Run ``fn`` on the pool, counting it as queued until it starts."""
+        with self.queued_lock:
+            self.queued += 1
+        self.executor.submit(self.run_queued, fn, *args)
+
+    def run_queued(self, fn, *args):
+        with self.queued_lock:
+            self.queued -= 1
+        fn(*args)
+
+    def end_connection(self, request, client_address):
+        self.RequestHandlerClass.metrics.add("http_active_connections", -1)
+        self.shutdown_request(request)
+        shaper = self.RequestHandlerClass.shaper
+        if shaper:
+            shaper.disconnect(client_address[0])
+
+    def park(self, request, client_address, handler=None):
+        """Hand a connection waiting for its next request to the idle watcher."""
+        with self.parking_lock:
+            self.parking.append((request, client_address, handler))
+        self.wake_watcher()
+
+    def wake_watcher(self):
+        try:
+            self.waker.send(b"\0")
+        except OSError:
+            pass
+
+    def watch_idle(self):
+        """Serve parked connections on a worker once they become readable,
+        and close those idle for longer than the handler timeout."""
+        timeout = self.RequestHandlerClass.timeout
+        deadlines = {}
+        while self.watching:
+            for key, _ in self.idle.select(timeout=1):
+                if key.fileobj is self.wakeup:
+                    try:
+                        while self.wakeup.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if key.data is None:
+                    # A rejected connection: discard input until it hangs up
+                    try:
+                        if key.fileobj.recv(MAX_PART_HEADER_SIZE):
+                            continue
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        pass
+                    self.idle.unregister(key.fileobj)
+                    del deadlines[key.fileobj]
+                    self.close_request(key.fileobj)
+                    continue
+                self.idle.unregister(key.fileobj)
+                del deadlines[key.fileobj]
+                self.submit(self.process_request_thread, *key.data)
+            with self.parking_lock:
+                parking, self.parking = self.parking, []
+                draining, self.draining = self.draining, []
+            now = time.monotonic()
+            for parked in parking:
+                self.idle.register(parked[0], selectors.EVENT_READ, parked)
+                deadlines[parked[0]] = now + timeout if timeout else float("inf")
+            for request in draining:
+                self.idle.register(request, selectors.EVENT_READ)
+                deadlines[request] = now + REJECT_LINGER
+            for request, deadline in list(deadlines.items()):
+                if deadline <= now:
+                    parked = self.idle.unregister(request).data
+                    del deadlines[request]
+                    if parked is None:
+                        self.close_request(request)
+                        continue
+                    request, client_address, handler = parked
+                    if handler is not None:
+                        handler.parked = False
+                        handler.finish()
+                    self.end_connection(request, client_address)
+
+    def reject_request(self, request):
+        """Answer a client over its connection cap with 429 and hang up.
+
+        Runs on the accepting thread and never blocks: the response fits in
+        the empty send buffer, and the idle watcher drains the connection
+        for a moment so that closing it does not reset the 429 away.
+        """
+        import ssl
+
+        self.RequestHandlerClass.metrics.add("http_rejected_connections")
+        if isinstance(request, ssl.SSLSocket):
+            # Answering would take a TLS handshake.
+            self.shutdown_request(request)
+            return
+        try:
+            request.setblocking(False)
+            request.send(TOO_MANY_CONNECTIONS)
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.close_request(request)
+            return
+        with self.parking_lock:
+            self.draining.append(request)
+        self.wake_watcher()
+
+    def server_close(self):
+        super().server_close()
+        self.watching = False
+        self.wake_watcher()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncioRequestHandler(CustomRequestHandler):
+    """CustomRequestHandler driven by the asyncio engine.
+
+    The request head is parsed from memory and the response headers are
+    collected in ``wfile``; the body is left in ``self.body`` for the event
+    loop to stream with backpressure. Only an interim ``100 Continue`` goes
+    straight to ``writer``, as the body is read before ``wfile`` is sent.
+    """
+
+    record_on_finish = False
+
+    def __init__(self, head, reader, writer, client_address, loop):
+        self.rfile = BlockingStreamReader(head, reader, loop, self.timeout)
+        self.wfile = io.BytesIO()
+        self.writer = writer
+        self.loop = loop
+        self.client_address = client_address
+        self.body = None
+
+    def handle_expect_100(self):
+        interim = f"{self.protocol_version} 100 Continue\r\n\r\n".encode()
+        self.loop.call_soon_threadsafe(self.writer.write, interim)
+        return True
+
+    def do_GET(self):
+        self.body = self.send_head()
+
+    def do_HEAD(self):
+        close_body(self.send_head())
+
+    async def stream_body(self, writer):
+        import asyncio
+
+        body = self.body
+        if body is None:
+            return
+        if isinstance(body, bytes):
+            await self.pace_async(len(body))
+            writer.write(body)
+            self.bytes_sent += len(body)
+            await writer.drain()
+            return
+        loop = asyncio.get_running_loop()
+        if not isinstance(body, FileBody):
+            # Listings, compression and archives read the disk and burn CPU
+            # while producing a chunk, so each one is made off the loop.
+            chunks = iter(body)
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await self.pace_async(len(chunk))
+                    writer.write(frame_chunk(chunk) if self.chunked else chunk)
+                    self.bytes_sent += len(chunk)
+                    await writer.drain()
+            if self.chunked:
+                writer.write(LAST_CHUNK)
+            return
+        tls = writer.get_extra_info("ssl_object") is not None
+        for segment in body.segments:
+            if isinstance(segment, bytes):
+                await self.pace_async(len(segment))
+                writer.write(segment)
+                self.bytes_sent += len(segment)
+                await writer.drain()
+                continue
+            for piece in self.shaped_pieces(*segment):
+                await self.pace_async(piece[1])
+                if tls:
+                    self.bytes_sent += await self.stream_mmap(writer, body.f, *piece)
+                else:
+                    self.bytes_sent += await loop.sendfile(
+                        writer.transport, body.f, *piece
+                    )
+
+    async def pace_async(self, n):
+        import asyncio
+
+        delay = self.throttle(n)
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def stream_mmap(self, writer, f, offset, count):
+        """Send a file range over TLS from a memory map in large writes.
+
+        The SSL transport may hold on to written buffers, so each slice is
+        copied out of the map rather than passed as a ``memoryview``.
+        """
+        import asyncio
+
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            loop = asyncio.get_running_loop()
+            return await loop.sendfile(writer.transport, f, offset, count)
+        loop = asyncio.get_running_loop()
+        with m:
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            start, end = offset, min(offset + count, len(m))
+            while offset < end:
+                n = min(TLS_WRITE_SIZE, end - offset)
+                # Copying the slice faults in pages from disk.
+                data = await loop.run_in_executor(
+                    None, m.__getitem__, slice(offset, offset + n)
+                )
+                writer.write(data)
+                offset += n
+                await writer.drain()
+        return offset - start
+
+
+class BlockingStreamReader:
+    """Blocking file-like reader over an already-read head and a StreamReader.
+
+    Used from worker threads, e.g. while parsing an upload, so that the
+    request body is pulled from the event loop chunk by chunk. A read that
+    gets no data for ``timeout`` seconds raises TimeoutError.
+    """
+
+    def __init__(self, head, reader, loop, timeout=None):
+        self.head = io.BytesIO(head)
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+
+    def readline(self, limit=-1):
+        return self.head.readline(limit)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def read(self, n=-1):
+        data = self.head.read(n)
+        if data:
+            return data
+        import asyncio
+
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self.reader.read(n), self.timeout), self.loop
+        )
+        return future.result()
+
+
+async def reject_connection(reader, writer):
+    import asyncio
+
+    CustomRequestHandler.metrics.add("http_rejected_connections")
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 1)
+        writer.write(TOO_MANY_CONNECTIONS)
+        await writer.drain()
+    except (
+        ConnectionError,
+        asyncio.IncompleteReadError,
+        asyncio.LimitOverrunError,
+        asyncio.TimeoutError,
+    ):
+        pass
+    finally:
+        writer.close()
+
+
+async def handle_connection(reader, writer, semaphore, timeout, upload_executor):
+    shaper = CustomRequestHandler.shaper
+    client_address = writer.get_extra_info("peername")
+    if shaper and not shaper.connect(client_address[0]):
+        await reject_connection(reader, writer)
+        return
+    try:
+        async with semaphore:
+            await serve_connection(
+                reader, writer, client_address, timeout, upload_executor
+            )
+    finally:
+        if shaper:
+            shaper.disconnect(client_address[0])
+
+
+async def serve_connection(reader, writer, client_address, timeout, upload_executor):
+    import asyncio
+
+    metrics = CustomRequestHandler.metrics
+    shaper = CustomRequestHandler.shaper
+    loop = asyncio.get_running_loop()
+    metrics.add("http_active_connections", 1)
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+            except (
+                asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError,
+                asyncio.TimeoutError,
+            ):
+                break
+            handler = AsyncioRequestHandler(head, reader, writer, client_address, loop)
+            # Uploads wait on the client while they read the body, so they
+            # get their own threads and cannot starve downloads.
+            if head.startswith((b"POST ", b"PUT ")):
+                executor = upload_executor
+            else:
+                executor = None
+            await loop.run_in_executor(executor, handler.handle_one_request)
+            writer.write(handler.wfile.getvalue())
+            handler.first_byte_at = time.perf_counter()
+            if handler.body:
+                metrics.add("http_inflight_downloads", 1)
+                if shaper:
+                    shaper.start_download(client_address[0])
+            try:
+                await handler.stream_body(writer)
+            finally:
+                close_body(handler.body)
+                if handler.body:
+                    metrics.add("http_inflight_downloads", -1)
+                    if shaper:
+                        shaper.finish_download(client_address[0])
+            await writer.drain()
+            handler.record_request()
+            if handler.close_connection:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        metrics.add("http_active_connections", -1)
+        writer.close()
+
+
+async def serve_asyncio(port, max_connections, timeout, workers, ssl_context=None):
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    semaphore = asyncio.Semaphore(max_connections)
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http-worker")
+    )
+    upload_executor = ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="http-upload"
+    )
+    server = await asyncio.start_server(
+        lambda r, w: handle_connection(r, w, semaphore, timeout, upload_executor),
+        None,
+        port,
+        ssl=ssl_context,
+        backlog=socket.SOMAXCONN,
+    )
+    async with server:
+        await server.serve_forever()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Simple HTTP File Server")
     parser.add_argument("--port", type=int, default=8000, help="Port number")
+    parser.add_argument(
+        "--engine",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="Serving engine",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=32,
+        help="Worker threads of the threaded engine; "
+        "the asyncio engine has as many for requests and for uploads",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=256,
+        help="Connections served at once by the asyncio engine",
+    )
+    parser.add_argument(
+        "--listing-cache",
+        type=int,
+        default=128,
+        help="Directory listings kept in memory",
+    )
+    parser.add_argument(
+        "--listing-cache-mb",
+        type=int,
+        default=64,
+        help="Memory for cached directory listings in MB",
+    )
+    parser.add_argument(
+        "--compress-cache",
+        metavar="DIR",
+        help="Directory to keep compressed copies of served files in, "
+        "one per file and encoding",
+    )
+    parser.add_argument(
+        "--file-cache-mb",
+        type=int,
+        default=64,
+        help="Memory for caching small files, 0 disables the cache",
+    )
+    parser.add_argument(
+        "--file-cache-max-kb",
+        type=int,
+        default=256,
+        help="Largest file kept in the small-file cache",
+    )
+    parser.add_argument(
+        "--inotify",
+        action="store_true",
+        help="Invalidate the small-file cache with inotify instead of stat",
+    )
+    parser.add_argument(
+        "--tls",
+        nargs=2,
+        metavar=("CERT", "KEY"),
+        help="Serve HTTPS with this certificate and private key",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=10, help="Keep-alive idle timeout (s)"
+    )
+    parser.add_argument(
+        "--max-upload-mb",
+        type=int,
+        default=0,
+        help="Largest chunked upload, 0 for any that fits the free space",
+    )
+    parser.add_argument(
+        "--upload-expiry-hours",
+        type=float,
+        default=UPLOAD_EXPIRY / 3600,
+        help="Delete unfinished chunked uploads idle this long, 0 to keep them",
+    )
+    parser.add_argument(
+        "--content-store",
+        metavar="DIR",
+        help="Deduplicate uploads by content into this directory "
+        "(same filesystem as the share for hardlinks)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="Total download bandwidth in MB/s, 0 for unlimited",
+    )
+    parser.add_argument(
+        "--client-rate-limit",
+        type=float,
+        default=0,
+        help="Download bandwidth per client IP in MB/s, 0 for unlimited",
+    )
+    parser.add_argument(
+        "--max-client-connections",
+        type=int,
+        default=0,
+        help="Concurrent connections per client IP, 0 for unlimited",
+    )
+    parser.add_argument(
+        "--priority-kb",
+        type=int,
+        default=256,
+        help="Responses up to this size are sent without rate limiting, "
+        "up to this many bytes per client and second",
+    )
     args = parser.parse_args()
 
     port = args.port
-    ip_addr = get_local_ip()
+
+    CustomRequestHandler.timeout = args.timeout
+    CustomRequestHandler.listing_cache = ListingCache(
+        args.listing_cache, args.listing_cache_mb << 20
+    )
+    CustomRequestHandler.uploads = UploadRegistry(
+        args.max_upload_mb << 20, args.upload_expiry_hours * 3600
+    )
+    if args.file_cache_mb > 0:
+        file_cache = FileCache(
+            args.file_cache_mb << 20,
+            args.file_cache_max_kb << 10,
+            CustomRequestHandler.metrics,
+        )
+        if args.inotify:
+            file_cache.enable_inotify()
+        CustomRequestHandler.file_cache = file_cache
+    if args.content_store:
+        store = ContentStore(os.path.abspath(args.content_store))
+        CustomRequestHandler.content_store = UploadSession.content_store = store
+    if args.rate_limit or args.client_rate_limit or args.max_client_connections:
+        CustomRequestHandler.shaper = BandwidthShaper(
+            args.rate_limit * 2**20,
+            args.client_rate_limit * 2**20,
+            args.max_client_connections,
+            args.priority_kb << 10,
+        )
+    if args.compress_cache:
+        os.makedirs(args.compress_cache, exist_ok=True)
+        CustomRequestHandler.compress_cache = os.path.abspath(args.compress_cache)
+
+    ssl_context = None
+    scheme = "http"
+    if args.tls:
+        import ssl
+
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(*args.tls)
+        scheme = "https"
 
     logging.basicConfig(level=logging.INFO)
-    with ThreadingHTTPServer(("", port), CustomRequestHandler) as httpd:
-        logging.info(f"Serving on http://{ip_addr}:{port}")
-        httpd.serve_forever()
+    for ip in get_local_ips() or ["::"]:
+        host = f"[{ip}]" if ":" in ip else ip
+        logging.info(f"Serving on {scheme}://{host}:{port}")
+    if args.engine == "asyncio":
+        import asyncio
+
+        try:
+            asyncio.run(
+                serve_asyncio(
+                    port, args.max_connections, args.timeout, args.workers, ssl_context
+                )
+            )
+        except KeyboardInterrupt:
+            pass
+    else:
+        with ThreadPoolHTTPServer(
+            ("", port), CustomRequestHandler, args.workers
+        ) as httpd:
+            if ssl_context:
+                # The handshake runs on the worker thread at the first read,
+                # not in the accept loop.
+                httpd.socket = ssl_context.wrap_socket(
+                    httpd.socket, server_side=True, do_handshake_on_connect=False
+                )
+            httpd.serve_forever()
@@ -1,10 +1,64 @@
-from functools import partial
+import argparse
+import csv
+import os
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import NamedTuple
+
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
 
 
 def month_ratio(year_rate, month):
     return (1 + year_rate / 12) ** month
 
 
+class DiscountCache:
+    """Monthly discount factors (1 + r/12) ** -t, t = 1..horizon, per rate.
+
+    A table is built with a cumulative product rather than a pow per term.
+    Each rate keeps the table of the longest horizon asked for, and shorter
+    horizons are slices of it, so every loan evaluated at the same rate
+    shares one table. Least recently used rates go once the tables take
+    more than ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.tables = OrderedDict()
+
+    def get(self, rate, horizon):
+        table = self.tables.get(rate)
+        if table is not None and len(table) >= horizon:
+            self.tables.move_to_end(rate)
+            return table[:horizon]
+        table = np.cumprod(np.full(horizon, 1 / (1 + rate / 12)))
+        table.flags.writeable = False
+        old = self.tables.pop(rate, None)
+        if old is not None:
+            self.size -= old.nbytes
+        self.tables[rate] = table
+        self.size += table.nbytes
+        while self.size > self.max_bytes and len(self.tables) > 1:
+            self.size -= self.tables.popitem(last=False)[1].nbytes
+        return table
+
+
+discount_cache = DiscountCache()
+
+
 def binary_search(l, r, check):
     while l + 1e-8 < r:
         mid = (l + r) / 2
@@ -22,56 +76,395 @@ def judge(
     inflow_list,
     info=False,
 ):
-    inflow_total_present = 0
-
-    for idx, inflow in enumerate(inflow_list):
-        t = idx + 1
-        inflow_term_present = inflow / month_ratio(r, t)
-        if info:
-            print("第{}期\t{}".format(t, inflow_term_present))
-        inflow_total_present += inflow_term_present
+    factors = discount_cache.get(r, len(inflow_list))
+    inflow_total_present = float(np.dot(inflow_list, factors))
 
     cost_total_present = principal - rebate
 
     diff = inflow_total_present - cost_total_present
 
     if info:
-        print("流入现值总和\t{}".format(inflow_total_present))
-        print("流出现值总和\t{}".format(cost_total_present))
+        sys.stdout.write(period_table(r, principal, rebate, inflow_list))
 
     return diff > 0
 
 
+def as_schedules(inflows):
+    """一维 (单笔贷款) 或二维 (每行一笔贷款, 期数不足的补 0) 现金流"""
+    flows = np.asarray(inflows, dtype=np.float64)
+    if flows.ndim == 1:
+        flows = flows[np.newaxis, :]
+    return flows
+
+
+def npv_and_slope(rates, cost, flows, weighted):
+    """Net present value of each schedule at ``rates`` and its derivative."""
+    base = 1 + rates[:, np.newaxis] / 12
+    if rates.size and (rates == rates[0]).all():
+        # E.g. the bracket ends: every loan shares one cached table.
+        discount = discount_cache.get(float(rates[0]), flows.shape[1])
+        discount = np.broadcast_to(discount, flows.shape)
+    else:
+        discount = np.cumprod(np.broadcast_to(1 / base, flows.shape), axis=1)
+    npv = np.einsum("ij,ij->i", flows, discount) - cost
+    slope = -np.einsum("ij,ij->i", weighted, discount / base) / 12
+    return npv, slope
+
+
+def solve_bracketed(f_and_slope, x, low, high, tol=1e-10, max_iter=100):
+    """Find a root of many monotonic functions at once.
+
+    ``f_and_slope(x, idx)`` evaluates problems ``idx`` at ``x``. Each
+    problem is oriented by its sign at ``low``, so functions may increase as
+    well as decrease, and takes Newton steps kept inside its bracket: a step
+    that leaves it is replaced by the midpoint, so convergence is never worse
+    than ``binary_search``. A problem whose root lies within ``tol`` of
+    ``low`` or ``high`` (e.g. a 0% loan) gets that end; problems without a
+    sign change on [low, high] get NaN.
+    """
+    n = len(x)
+    everything = np.arange(n)
+    lo = np.full(n, float(low))
+    hi = np.full(n, float(high))
+    with np.errstate(over="ignore"):
+        f_lo, df_lo = f_and_slope(lo, everything)
+        f_hi, df_hi = f_and_slope(hi, everything)
+    # A Newton step shorter than tol from an end means the root is there.
+    at_lo = np.abs(f_lo) <= tol * np.abs(df_lo)
+    at_hi = ~at_lo & (np.abs(f_hi) <= tol * np.abs(df_hi))
+    sign = np.where(f_lo > 0, 1.0, -1.0)
+    valid = (sign * f_lo > 0) & (sign * f_hi <= 0) & ~at_lo & ~at_hi
+    x = np.where((x > lo) & (x < hi), x, (lo + hi) / 2)
+
+    active = np.flatnonzero(valid)
+    for _ in range(max_iter):
+        if not active.size:
+            break
+        xa, la, ha = x[active], lo[active], hi[active]
+        f, df = f_and_slope(xa, active)
+        f, df = f * sign[active], df * sign[active]
+        above = f > 0
+        la = np.where(above, xa, la)
+        ha = np.where(above, ha, xa)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = xa - f / df
+        step = np.where((step > la) & (step < ha), step, (la + ha) / 2)
+        step = np.where(f == 0, xa, step)
+        lo[active], hi[active], x[active] = la, ha, step
+        done = (np.abs(step - xa) < tol) | (ha - la < tol) | (f == 0)
+        active = active[~done]
+    x[~valid] = np.nan
+    x[at_lo] = lo[at_lo]
+    x[at_hi] = hi[at_hi]
+    return x
+
+
+def irr_batch(principal, rebate, inflows, low=0.0, high=10.0, tol=1e-10, max_iter=100):
+    """
+    principal                       本金, 标量或每笔贷款一个
+    rebate                          回扣, 标量或每笔贷款一个
+    inflows                         每期现金流, 一维或 (贷款数, 期数)
+
+    Returns one annual rate per loan, compounded monthly as in ``judge``.
+    """
+    flows = as_schedules(inflows)
+    n, periods = flows.shape
+    cost = np.broadcast_to(
+        np.asarray(principal, dtype=np.float64) - np.asarray(rebate, dtype=np.float64),
+        (n,),
+    ).copy()
+    weighted = flows * np.arange(1, periods + 1)
+
+    def f_and_slope(rates, idx):
+        return npv_and_slope(rates, cost[idx], flows[idx], weighted[idx])
+
+    # Start from the rate that pays back the total inflow at the cash-weighted
+    # mean payment time; usually a few Newton steps from the root.
+    total = flows.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_t = weighted.sum(axis=1) / total
+        x = 12 * ((total / cost) ** (1 / mean_t) - 1)
+    return solve_bracketed(f_and_slope, x, low, high, tol, max_iter)
+
+
+def solve_irr(principal, rebate, inflow_list):
+    return float(irr_batch(principal, rebate, inflow_list)[0])
+
+
+def xnpv_and_slope(rates, codes, years, amounts, n):
+    """NPV per group of dated cash flows, at one annual rate per group."""
+    base = 1 + rates[codes]
+    discount = base**-years
+    npv = np.bincount(codes, amounts * discount, minlength=n)
+    slope = -np.bincount(codes, amounts * years * discount / base, minlength=n)
+    return npv, slope
+
+
+def xirr_by_group(codes, dates, amounts, low=-0.99, high=10.0, tol=1e-10):
+    """
+    codes                           每笔现金流所属贷款的编号 (0 .. n-1)
+    dates                           日期, datetime64 或 ISO 字符串
+    amounts                         金额, 流出为负, 流入为正
+
+    Returns the annual effective rate of each group, with time counted in
+    days / 365 from the group's first cash flow, as Excel's XIRR does.
+    Rows need not be sorted.
+    """
+    codes = np.asarray(codes, dtype=np.intp)
+    days = np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    n = int(codes.max()) + 1 if codes.size else 0
+    first = np.full(n, np.iinfo(np.int64).max)
+    np.minimum.at(first, codes, days)
+    years = (days - first[codes]) / 365.0
+
+    def f_and_slope(rates, idx):
+        full = np.zeros(n)
+        full[idx] = rates
+        rows = np.zeros(n, dtype=bool)
+        rows[idx] = True
+        rows = rows[codes]
+        with np.errstate(over="ignore", invalid="ignore"):
+            npv, slope = xnpv_and_slope(
+                full, codes[rows], years[rows], amounts[rows], n
+            )
+        return npv[idx], slope[idx]
+
+    return solve_bracketed(f_and_slope, np.full(n, 0.1), low, high, tol)
+
+
+def xirr(dates, amounts):
+    """单笔贷款的 XIRR, dates 与 amounts 一一对应"""
+    amounts = np.asarray(amounts, dtype=np.float64)
+    codes = np.zeros(len(amounts), dtype=np.intp)
+    return float(xirr_by_group(codes, dates, amounts)[0])
+
+
+class CashFlows(NamedTuple):
+    labels: np.ndarray
+    codes: np.ndarray
+    dates: np.ndarray
+    amounts: np.ndarray
+
+
+def iter_cashflow_chunks(
+    path, group="loan_id", date="date", amount="amount", rows=1 << 20
+):
+    """Read (group, date, amount) columns from CSV or Parquet in chunks.
+
+    Yields ``(groups, dates, amounts)`` arrays of at most ``rows`` rows,
+    with dates as datetime64[D] and amounts as float64. pandas is used for
+    CSV when installed, the csv module otherwise; Parquet needs pyarrow.
+    """
+    columns = [group, date, amount]
+    if path.endswith(".parquet"):
+        if pq is None:
+            raise RuntimeError("读取 Parquet 需要 pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(rows, columns=columns):
+            yield (
+                batch.column(group).to_numpy(zero_copy_only=False),
+                batch.column(date)
+                .to_numpy(zero_copy_only=False)
+                .astype("datetime64[D]"),
+                batch.column(amount).to_numpy(zero_copy_only=False).astype(np.float64),
+            )
+    elif pd is not None:
+        reader = pd.read_csv(
+            path,
+            usecols=columns,
+            dtype={group: str, amount: np.float64},
+            chunksize=rows,
+        )
+        for frame in reader:
+            yield (
+                frame[group].to_numpy(),
+                frame[date].to_numpy(dtype=str).astype("datetime64[D]"),
+                frame[amount].to_numpy(),
+            )
+    else:
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            index = [header.index(c) for c in columns]
+            while True:
+                chunk = np.array(list(islice(reader, rows)), dtype=str)
+                if not chunk.size:
+                    break
+                yield (
+                    chunk[:, index[0]],
+                    chunk[:, index[1]].astype("datetime64[D]"),
+                    chunk[:, index[2]].astype(np.float64),
+                )
+
+
+def load_cashflows(path, group="loan_id", date="date", amount="amount", rows=1 << 20):
+    """Load a cash-flow table into compact arrays, one integer code per group."""
+    index = {}
+    codes, dates, amounts = [], [], []
+    for groups, chunk_dates, chunk_amounts in iter_cashflow_chunks(
+        path, group, date, amount, rows
+    ):
+        labels, inverse = np.unique(groups, return_inverse=True)
+        lookup = np.array([index.setdefault(l, len(index)) for l in labels])
+        codes.append(lookup[inverse].astype(np.intp))
+        dates.append(chunk_dates)
+        amounts.append(chunk_amounts)
+    return CashFlows(
+        np.array(list(index)),
+        np.concatenate(codes) if codes else np.zeros(0, dtype=np.intp),
+        np.concatenate(dates) if dates else np.zeros(0, dtype="datetime64[D]"),
+        np.concatenate(amounts) if amounts else np.zeros(0),
+    )
+
+
+def xirr_file(path, **columns):
+    """Annual XIRR of every loan in a CSV/Parquet file, keyed by its label."""
+    flows = load_cashflows(path, **columns)
+    rates = xirr_by_group(flows.codes, flows.dates, flows.amounts)
+    return dict(zip(flows.labels.tolist(), rates.tolist()))
+
+
+def period_table(r, principal, rebate, inflow_list):
+    """每期现值表, 整张表拼成一个字符串返回"""
+    inflows = np.asarray(inflow_list, dtype=np.float64)
+    present = inflows * discount_cache.get(r, len(inflows))
+    lines = [f"第{t}期\t{v}" for t, v in enumerate(present.tolist(), 1)]
+    lines.append("流入现值总和\t{}".format(present.sum()))
+    lines.append("流出现值总和\t{}".format(principal - rebate))
+    return "\n".join(lines) + "\n"
+
+
 def irr(principal, rebate, inflow_list, info):
     """
     principal                       本金
     rebate                          回扣
     inflow_list                     每期现金流
+    info                            是否输出每期现值表
     """
-    check = partial(
-        judge,
-        principal=principal,
-        rebate=rebate,
-        inflow_list=inflow_list,
-        info=info,
-    )
-    check_with_info = partial(
-        judge,
-        principal=principal,
-        rebate=rebate,
-        inflow_list=inflow_list,
-        info=True,
-    )
-    r = binary_search(0.0, 10.0, check)
-    check_with_info(r)
+    r = solve_irr(principal, rebate, inflow_list)
+    if info:
+        sys.stdout.write(period_table(r, principal, rebate, inflow_list))
     print("\n-------------\n年化利率: {:.2f}%\n-------------\n".format(r * 100))
+    return r
 
 
-inflow_list = [9696 for _ in range(143)]
-inflow_list.append(76305.06)
-irr(
-    principal=1.2e6,
-    rebate=0,
-    inflow_list=inflow_list,
-    info=False,
-)
+# Offers are solved in chunks of MIN_OFFER_CHUNK to OFFER_CHUNK rows: enough
+# to keep every worker busy, few enough to bound each chunk's matrix.
+MIN_OFFER_CHUNK = 256
+OFFER_CHUNK = 4096
+
+
+def parse_schedule(spec):
+    """\"9696x143;76305.06\" 表示 143 期 9696, 再加一期 76305.06
+
+    Returns ``(amount, count)`` pairs.
+    """
+    terms = []
+    for term in spec.split(";"):
+        amount, _, count = term.strip().partition("x")
+        terms.append((float(amount), int(count or 1)))
+    return terms
+
+
+def expand_schedule(terms):
+    amounts, counts = zip(*terms)
+    return np.repeat(amounts, counts)
+
+
+def read_offers(path):
+    """CSV 文件, 列为 name, principal, rebate (可省略), schedule"""
+    with open(path, newline="", encoding="utf-8") as f:
+        return [
+            (
+                row["name"],
+                float(row["principal"]),
+                float(row.get("rebate") or 0),
+                parse_schedule(row["schedule"]),
+            )
+            for row in csv.DictReader(f)
+        ]
+
+
+def solve_offers(offers):
+    periods = [sum(count for _, count in terms) for _, _, _, terms in offers]
+    flows = np.zeros((len(offers), max(periods)))
+    for row, (_, _, _, terms) in zip(flows, offers):
+        start = 0
+        for amount, count in terms:
+            row[start : start + count] = amount
+            start += count
+    principal = np.array([offer[1] for offer in offers])
+    rebate = np.array([offer[2] for offer in offers])
+    return irr_batch(principal, rebate, flows)
+
+
+def rank_offers(offers, workers=None):
+    """Solve all offers, a chunk per process, and order them cheapest first.
+
+    Returns the rates and the ranking; offers without a rate come last.
+    """
+    share = -(-len(offers) // (workers or os.cpu_count() or 1))
+    size = min(max(share, MIN_OFFER_CHUNK), OFFER_CHUNK)
+    chunks = [offers[i : i + size] for i in range(0, len(offers), size)]
+    if workers == 1 or len(chunks) <= 1:
+        rates = [solve_offers(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            rates = list(pool.map(solve_offers, chunks))
+    rates = np.concatenate(rates) if rates else np.zeros(0)
+    return rates, np.argsort(rates, kind="stable")
+
+
+def format_ranking(offers, rates, order):
+    lines = ["排名\t名称\t本金\t回扣\t期数\t年化利率"]
+    for rank, i in enumerate(order.tolist(), 1):
+        name, principal, rebate, terms = offers[i]
+        periods = sum(count for _, count in terms)
+        lines.append(
+            f"{rank}\t{name}\t{principal:.2f}\t{rebate:.2f}\t{periods}\t{rates[i] * 100:.4f}%"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较贷款方案的年化利率")
+    parser.add_argument("offers", nargs="?", help="贷款方案 CSV 文件")
+    parser.add_argument("--workers", type=int, help="进程数, 默认为 CPU 核数")
+    parser.add_argument("-o", "--output", help="排名表输出文件, 默认为标准输出")
+    parser.add_argument(
+        "--table",
+        action="append",
+        default=[],
+        metavar="NAME",
+        help="输出该方案的每期现值表",
+    )
+    args = parser.parse_args()
+
+    if args.offers is None:
+        inflow_list = [9696 for _ in range(143)]
+        inflow_list.append(76305.06)
+        irr(
+            principal=1.2e6,
+            rebate=0,
+            inflow_list=inflow_list,
+            info=False,
+        )
+        return
+
+    offers = read_offers(args.offers)
+    rates, order = rank_offers(offers, args.workers)
+    text = format_ranking(offers, rates, order)
+    tables = set(args.table)
+    for (name, principal, rebate, terms), r in zip(offers, rates.tolist()):
+        if name in tables:
+            schedule = expand_schedule(terms)
+            text += f"\n{name}\n" + period_table(r, principal, rebate, schedule)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main()